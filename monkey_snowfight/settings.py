@@ -82,6 +82,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',
     'django_htmx.middleware.HtmxMiddleware',
+    'monkeychat.metrics.MetricsMiddleware',
 ]
 if DEBUG:
     MIDDLEWARE += ['django_browser_reload.middleware.BrowserReloadMiddleware']
@@ -116,13 +117,20 @@ ASGI_APPLICATION = 'monkey_snowfight.asgi.application'
 
 
 
+# Redis instances the realtime tier spreads rooms across: comma-separated
+# "name=url" entries (see monkeychat.sharding). Keep names stable; a room's
+# shard follows the names, not the order. Defaults to REDISCLOUD_URL alone.
+CHAT_REDIS_SHARDS = [entry for entry in os.environ.get('CHAT_REDIS_SHARDS', '').split(',') if entry.strip()]
+if not CHAT_REDIS_SHARDS and os.environ.get("REDISCLOUD_URL"):
+    CHAT_REDIS_SHARDS = [os.environ.get("REDISCLOUD_URL")]
+
 # Use in-memory channel layer for local development, Redis for production
-if os.environ.get("REDISCLOUD_URL"):
+if CHAT_REDIS_SHARDS:
     CHANNEL_LAYERS = {
         "default": {
-            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "BACKEND": "monkeychat.sharding.ShardedRedisChannelLayer",
             "CONFIG": {
-                "hosts": [os.environ.get("REDISCLOUD_URL")],
+                "shards": CHAT_REDIS_SHARDS,
             },
         },
     }
@@ -133,6 +141,41 @@ else:
         }
     }
 
+# Shared cache so per-room chat data stays consistent across daphne processes.
+# Fragment, profile version and chat list entries are invalidated by key, so
+# they must all live on one Redis: REDISCLOUD_URL, else the first chat shard.
+CACHE_REDIS_URL = os.environ.get("REDISCLOUD_URL")
+if not CACHE_REDIS_URL and CHAT_REDIS_SHARDS:
+    name, separator, url = CHAT_REDIS_SHARDS[0].strip().partition('=')
+    CACHE_REDIS_URL = url if separator else name
+if CACHE_REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_REDIS_URL,
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    }
+
+# Seconds a chat connection stays online without a heartbeat (see monkeychat.redis_utils)
+CHAT_PRESENCE_TTL = int(os.environ.get('CHAT_PRESENCE_TTL', 90))
+# Minimum seconds between online count broadcasts for one room (see monkeychat.coalesce)
+CHAT_PRESENCE_BROADCAST_INTERVAL = float(os.environ.get('CHAT_PRESENCE_BROADCAST_INTERVAL', 0.25))
+# Frames for one socket within this many milliseconds are sent as one, and a
+# socket with more than CHAT_OUTBOUND_LIMIT waiting is disconnected (see monkeychat.coalesce)
+CHAT_OUTBOUND_WINDOW_MS = int(os.environ.get('CHAT_OUTBOUND_WINDOW_MS', 50))
+CHAT_OUTBOUND_LIMIT = int(os.environ.get('CHAT_OUTBOUND_LIMIT', 100))
+
+# Write-behind chat messages: broadcast at once, stored in batches (see monkeychat.writebehind)
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', 'False') == 'True'
+CHAT_WRITE_BEHIND_INTERVAL_MS = int(os.environ.get('CHAT_WRITE_BEHIND_INTERVAL_MS', 200))
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BEHIND_BATCH_SIZE', 100))
+
 
 # Use Heroku Postgres if available, else default to SQLite
 DATABASES = {
@@ -205,8 +248,34 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 if os.environ.get('CLOUDINARY_URL'):
     DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
+    CHAT_UPLOAD_BACKEND = 'monkeychat.images.CloudinaryBackend'
 else:
     DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+    CHAT_UPLOAD_BACKEND = 'monkeychat.images.StorageBackend'
+
+# Chat latency and query metrics, served to staff at /metrics/ (see monkeychat.metrics)
+CHAT_METRICS = os.environ.get('CHAT_METRICS', 'True') == 'True'
+
+# Per-request query counts, duplicate queries and template render time, as
+# response headers and console log lines (see monkeychat.profiling)
+CHAT_PROFILING = os.environ.get('CHAT_PROFILING', 'False') == 'True'
+if CHAT_PROFILING:
+    MIDDLEWARE.insert(0, 'monkeychat.profiling.QueryProfilingMiddleware')
+    LOGGING = {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'handlers': {'console': {'class': 'logging.StreamHandler'}},
+        'loggers': {'monkeychat.profiling': {'handlers': ['console'], 'level': 'INFO'}},
+    }
+
+# WebSocket frames the pages ask for: 'html' for htmx fragments, or the compact
+# 'json' / 'msgpack' protocols rendered in the browser (see monkeychat.protocol)
+CHAT_WS_PROTOCOL = os.environ.get('CHAT_WS_PROTOCOL', 'html')
+
+# Threads uploading chat attachments in the background (see monkeychat.uploads)
+CHAT_UPLOAD_WORKERS = int(os.environ.get('CHAT_UPLOAD_WORKERS', 4))
+# Minutes after which fail_stale_uploads gives up on an upload lost to a restart
+CHAT_STALE_UPLOAD_MINUTES = int(os.environ.get('CHAT_STALE_UPLOAD_MINUTES', 15))
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -20,6 +20,7 @@ from django.conf.urls.static import static
 from django.conf import settings
 from monkeyusers.views import profile_view, CustomConfirmEmailView
 from monkeyhome.views import *
+from monkeychat.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -31,6 +32,7 @@ urlpatterns = [
     path('play/', include('monkeygame.urls')),
     path('profile/', include('monkeyusers.urls')),
     path('@<username>/', profile_view, name="profile"),
+    path('metrics/', metrics_view, name="metrics"),
 ]
 
 # Only used when DEBUG=True, whitenoise can serve files when DEBUG=False
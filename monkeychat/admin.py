@@ -1,5 +1,18 @@
 from django.contrib import admin
 from .models import *
+from .recent import forget_deleted_messages
+
+
+class ChatMessageAdmin(admin.ModelAdmin):
+    # Deleted messages must not linger in their room's recent messages ring
+    def delete_model(self, request, obj):
+        forget_deleted_messages(ChatMessage.objects.filter(id=obj.id))
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        forget_deleted_messages(queryset)
+        super().delete_queryset(request, queryset)
+
 
 admin.site.register(ChatRoom)
-admin.site.register(ChatMessage)
\ No newline at end of file
+admin.site.register(ChatMessage, ChatMessageAdmin)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AmonkeychatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'monkeychat'
+
+    def ready(self):
+        import monkeychat.signals
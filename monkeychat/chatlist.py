@@ -0,0 +1,62 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Prefetch
+from .models import ChatRoom
+
+# Each user's header chat list (group chats by name, private chats by the
+# other member's display name), built with two queries and cached until one of
+# the rooms, their members or a counterpart's profile changes. Online flags are
+# not part of it: they come live from presence at render time.
+CHAT_LIST_TTL = 60 * 60
+
+
+def _chat_list_key(user_id):
+    return f"chat-list:{user_id}"
+
+
+class ChatList:
+    def __init__(self, group_chats, private_chats):
+        # Lists of {'group_name': ..., 'name': ...}
+        self.group_chats = group_chats
+        self.private_chats = private_chats
+
+    @property
+    def chatroom_names(self):
+        return [
+            'public-chat',
+            *[chat['group_name'] for chat in self.group_chats],
+            *[chat['group_name'] for chat in self.private_chats],
+        ]
+
+
+def build_chat_list(user):
+    others = User.objects.exclude(id=user.id).select_related('profile')
+    chatrooms = user.chat_groups.prefetch_related(Prefetch('members', queryset=others, to_attr='others'))
+    group_chats = []
+    private_chats = []
+    for chatroom in chatrooms:
+        if chatroom.groupchat_name:
+            group_chats.append({'group_name': chatroom.group_name, 'name': chatroom.groupchat_name})
+        if chatroom.is_private:
+            for member in chatroom.others:
+                private_chats.append({'group_name': chatroom.group_name, 'name': member.profile.name})
+    return ChatList(group_chats, private_chats)
+
+
+def get_chat_list(user):
+    key = _chat_list_key(user.id)
+    chat_list = cache.get(key)
+    if chat_list is None:
+        chat_list = build_chat_list(user)
+        cache.set(key, chat_list, CHAT_LIST_TTL)
+    return chat_list
+
+
+def forget_chat_lists(user_ids):
+    cache.delete_many([_chat_list_key(user_id) for user_id in set(user_ids)])
+
+
+def forget_room_chat_lists(chatroom_ids):
+    """Drop the cached lists of everyone in these rooms"""
+    member_ids = ChatRoom.members.through.objects.filter(chatroom_id__in=chatroom_ids).values_list('user_id', flat=True)
+    forget_chat_lists(member_ids)
@@ -0,0 +1,91 @@
+import asyncio
+import time
+from django.conf import settings
+
+
+class BroadcastCoalescer:
+    """Collapses bursts of changes into at most one broadcast per key per interval.
+
+    The first change for an idle key is flushed straight away; changes arriving
+    while a flush is pending are absorbed by it. The flush callback reads the
+    state when it runs, so whatever gets sent is always the final state.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {}
+        self.last_sent = {}
+
+    def schedule(self, key, flush):
+        task = self.pending.get(key)
+        if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+            return
+        delay = max(0, self.last_sent.get(key, 0) + self.interval - time.monotonic())
+        self.pending[key] = asyncio.create_task(self._flush_later(key, delay, flush))
+
+    async def _flush_later(self, key, delay, flush):
+        await asyncio.sleep(delay)
+        # Clear before flushing so changes made during the send get their own slot
+        del self.pending[key]
+        self.last_sent[key] = time.monotonic()
+        await flush()
+
+
+presence_broadcasts = BroadcastCoalescer(getattr(settings, 'CHAT_PRESENCE_BROADCAST_INTERVAL', 0.25))
+
+
+class FrameBuffer:
+    """Collects the frames bound for one socket and sends each burst as one.
+
+    The first frame after a quiet spell goes out on the next loop turn; frames
+    arriving within window of the last send wait and go out together. A frame
+    pushed with a key replaces any queued frame with the same key, so only the
+    latest online count or status survives a burst.
+
+    push() returns False once limit frames are waiting, which means the client
+    is not keeping up; the consumer then disconnects it rather than buffering
+    without bound.
+    """
+
+    def __init__(self, flush, window, limit):
+        self.flush = flush
+        self.window = window
+        self.limit = limit
+        self.frames = []
+        self.task = None
+        self.last_sent = 0
+        self.closed = False
+
+    def push(self, frame, key=None):
+        if self.closed:
+            return True  # Already disconnecting; nothing more will be sent
+        if key is not None:
+            self.frames = [queued for queued in self.frames if queued[0] != key]
+        if len(self.frames) >= self.limit:
+            return False
+        self.frames.append((key, frame))
+        if self.task is None:
+            delay = max(0, self.last_sent + self.window - time.monotonic())
+            self.task = asyncio.create_task(self._flush_later(delay))
+        return True
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        try:
+            # Frames pushed while a send is in progress go out right after it
+            while self.frames:
+                frames, self.frames = self.frames, []
+                self.last_sent = time.monotonic()
+                await self.flush([frame for key, frame in frames])
+        finally:
+            self.task = None
+
+    def close(self):
+        self.closed = True
+        self.frames = []
+        if self.task is not None:
+            self.task.cancel()
+
+
+OUTBOUND_WINDOW = getattr(settings, 'CHAT_OUTBOUND_WINDOW_MS', 50) / 1000
+OUTBOUND_LIMIT = getattr(settings, 'CHAT_OUTBOUND_LIMIT', 100)
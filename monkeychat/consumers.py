@@ -1,167 +1,343 @@
-from channels.generic.websocket import WebsocketConsumer
-from django.shortcuts import get_object_or_404
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
 from django.template.loader import render_to_string
-from asgiref.sync import async_to_sync
-import json
+import asyncio
+from collections import deque
 from .models import *
+from .events import *
+from .coalesce import OUTBOUND_LIMIT, OUTBOUND_WINDOW, FrameBuffer, presence_broadcasts
+from .writebehind import create_message
+from .chatlist import get_chat_list
+from .history import SYNC_REPLAY_LIMIT, latest_messages, missed_messages
+from .metrics import room_kind, socket_closed, socket_opened, timed_event
+from .protocol import choose_protocol, decode_frame, encode_frame
+from . import redis_utils
 
-class ChatroomConsumer(WebsocketConsumer):
-    def connect(self):
+
+class PresenceMixin:
+    """Registers the socket in a presence room and keeps it alive with heartbeats"""
+
+    async def join_presence(self, room_name):
+        self.presence_room = room_name
+        became_online = await redis_utils.aadd_user_online(room_name, self.user.id, self.channel_name)
+        self.heartbeat_task = asyncio.create_task(self.send_heartbeats())
+        return became_online
+
+    async def leave_presence(self):
+        if not hasattr(self, 'presence_room'):
+            return False
+        self.heartbeat_task.cancel()
+        return await redis_utils.aremove_user_online(self.presence_room, self.user.id, self.channel_name)
+
+    async def send_heartbeats(self):
+        while True:
+            await asyncio.sleep(redis_utils.PRESENCE_HEARTBEAT)
+            await redis_utils.aheartbeat(self.presence_room, self.user.id, self.channel_name)
+
+
+class OutboundMixin:
+    """Negotiates the frame protocol and batches everything sent down the socket.
+
+    self.protocol stays None for HTML sockets. Frames are compact dicts or HTML
+    strings to match; a burst goes out as one JSON/msgpack array or as the
+    HTML fragments joined, which htmx swaps in one by one.
+    """
+    protocol = None
+    outbox = None
+
+    async def accept_protocol(self):
+        self.protocol = choose_protocol(self.scope.get('subprotocols', []))
+        self.outbox = FrameBuffer(self.flush_frames, OUTBOUND_WINDOW, OUTBOUND_LIMIT)
+        await self.accept(subprotocol=self.protocol)
+
+    async def send_frame(self, frame, key=None):
+        if not self.outbox.push(frame, key):
+            # Too slow to keep up; 1013 makes the client reconnect later, and it syncs then
+            self.outbox.close()
+            await self.close(code=1013)
+
+    async def flush_frames(self, frames):
+        if not self.protocol:
+            await self.send(text_data=''.join(frames))
+        elif len(frames) == 1:
+            await self.send(**encode_frame(self.protocol, frames[0]))
+        else:
+            await self.send(**encode_frame(self.protocol, frames))
+
+    def close_outbox(self):
+        if self.outbox is not None:
+            self.outbox.close()
+
+
+class ChatroomConsumer(OutboundMixin, PresenceMixin, AsyncWebsocketConsumer):
+    @timed_event('chatroom_connect')
+    async def connect(self):
         # Check if user is authenticated first
         if not self.scope["user"].is_authenticated:
-            self.close()
+            await self.close()
             return
-            
+
         self.user = self.scope["user"]
         self.chatroom_name = self.scope["url_route"]["kwargs"]["chatroom_name"]
-        self.chatroom = get_object_or_404(ChatRoom, group_name=self.chatroom_name)
+        try:
+            self.chatroom = await ChatRoom.objects.aget(group_name=self.chatroom_name)
+        except ChatRoom.DoesNotExist:
+            await self.close()
+            return
+        # Recent message ids sent down this socket, so a sync doesn't repeat them
+        self.delivered_ids = deque(maxlen=SYNC_REPLAY_LIMIT * 2)
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.chatroom_name,
             self.channel_name
         )
 
         # Add and update online users
-        if self.user not in self.chatroom.users_online.all():
-            self.chatroom.users_online.add(self.user)
+        became_online = await self.join_presence(self.chatroom_name)
+        await self.accept_protocol()
+        socket_opened('chatroom', room_kind(self.chatroom))
+        if became_online:
             self.update_online_count()
+            self.update_chat_status()
+        else:
+            # Another tab already counts this user, so only this socket needs the state
+            event = await database_sync_to_async(online_count_event)(self.chatroom, await self.get_online_count())
+            await self.online_count_handler(event)
 
-        self.accept()
-
-    def disconnect(self, close_code):
+    @timed_event('chatroom_disconnect')
+    async def disconnect(self, close_code):
+        self.close_outbox()
+        if hasattr(self, 'presence_room'):
+            socket_closed('chatroom', room_kind(self.chatroom))
         if hasattr(self, 'chatroom_name'):
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                 self.chatroom_name,
                 self.channel_name
-            )  
-        # Remove and update online users only if user was authenticated
-        if hasattr(self, 'user') and hasattr(self, 'chatroom') and self.user in self.chatroom.users_online.all():
-            self.chatroom.users_online.remove(self.user)
+            )
+        # Remove and update online users once their last tab has closed
+        if await self.leave_presence():
             self.update_online_count()
+            self.update_chat_status()
 
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    @timed_event('chatroom_receive')
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = decode_frame(text_data, bytes_data)
+        if 'sync' in text_data_json:
+            await self.sync(text_data_json['sync'])
+            return
         body = text_data_json["body"]
-        
+
         # Don't create message if empty or just whitespace
         if not body or not body.strip():
             return
 
-        message = ChatMessage.objects.create(
+        message = await create_message(
             body = body.strip(),
             author = self.user,
             group = self.chatroom
         )
 
-        context = {
-            'message': message, 
-            'user': self.user, 
-        }
-        event = {
-            'type': 'message_handler',
-            'message_id': message.id,
-        }
+        # Render once here; every socket in the group reuses the payload
+        event = await database_sync_to_async(message_event)(message, self.chatroom)
 
-        async_to_sync(self.channel_layer.group_send)(
+        await self.channel_layer.group_send(
             self.chatroom_name, event
         )
 
-    def message_handler(self, event):
-        message_id = event['message_id']
-        message = ChatMessage.objects.get(id=message_id)
-        context = {
-            'message': message,
-            'user' : self.user,
-            'chat_group': self.chatroom,
-        }
-        html = render_to_string("monkeychat/partials/chat_message_p.html", context=context)
-        self.send(text_data=html)
+    @timed_event('message_handler')
+    async def message_handler(self, event):
+        if event['message_id'] in self.delivered_ids:
+            return
+        self.delivered_ids.append(event['message_id'])
+        if self.protocol:
+            await self.send_frame({'type': 'message', 'message': event['data'], 'author_online': event['author_online']})
+        else:
+            await self.send_html_variant(event)
+
+    @timed_event('message_update_handler')
+    async def message_update_handler(self, event):
+        if self.protocol:
+            await self.send_frame({'type': 'message_update', 'message': event['data']})
+        else:
+            # Same payload shape; the <li> id makes htmx swap it over the old one
+            await self.send_html_variant(event)
+
+    async def send_html_variant(self, event):
+        if event['author_id'] == self.user.id:
+            html = event['html_own']
+        else:
+            html = event['html_other']
+        await self.send_frame(html)
+
+    @timed_event('chatroom_sync')
+    async def sync(self, cursor):
+        # Sent by the client whenever its socket opens, with its newest message
+        position = None
+        if cursor:
+            position = ChatMessage.parse_cursor(cursor)
+            if position is None:
+                return
+        messages = await database_sync_to_async(missed_messages)(self.chatroom, position)
+        refresh = messages is None
+        if refresh:
+            # Too far behind to replay; replace the client's list with the latest page
+            messages = await database_sync_to_async(latest_messages)(self.chatroom)
+        else:
+            messages = [message for message in messages if message.id not in self.delivered_ids]
+            if not messages:
+                return
+        self.delivered_ids.extend(message.id for message in messages)
+
+        if self.protocol:
+            data = await database_sync_to_async(messages_data)(messages[::-1])  # Oldest first
+            await self.send_frame({'type': 'sync', 'messages': data, 'refresh': refresh})
+        else:
+            context = {'chat_messages': messages, 'refresh': refresh, 'user': self.user}
+            await self.send_frame(await database_sync_to_async(render_to_string)(SYNC_TEMPLATE, context))
 
     def update_online_count(self):
-        online_count = self.chatroom.users_online.count() - 1  # Get actual count of users online
-        event = {
-                'type': 'online_count_handler',
-                'online_count': online_count
-            }
-        async_to_sync(self.channel_layer.group_send)(self.chatroom_name, event)
+        # Joins and leaves within the broadcast interval share a single event
+        presence_broadcasts.schedule(self.chatroom_name, self.broadcast_online_count)
 
-    def online_count_handler(self, event):
-        online_count = event['online_count']
+    async def get_online_count(self):
+        return await redis_utils.aget_online_count(self.chatroom_name) - 1  # Get actual count of users online
 
-        chat_messages = ChatRoom.objects.get(group_name=self.chatroom_name).chat_messages.all()[:30]
-        author_ids = set([message.author.id for message in chat_messages])
-        users = User.objects.filter(id__in=author_ids)
+    async def broadcast_online_count(self):
+        # Rendered once for the whole room; handlers just forward the HTML
+        event = await database_sync_to_async(online_count_event)(self.chatroom, await self.get_online_count())
+        await self.channel_layer.group_send(self.chatroom_name, event)
 
+    @timed_event('online_count_handler')
+    async def online_count_handler(self, event):
+        if self.protocol:
+            frame = {'type': 'online_count', 'count': event['online_count'], 'online': event['online_user_ids']}
+        else:
+            frame = event['html']
+        await self.send_frame(frame, key='online_count')
 
-        context = {
-            'online_count': online_count,
-            'chat_group': self.chatroom,
-            'users': users,
-        }
-        html = render_to_string("monkeychat/partials/online_count.html", context)
-        self.send(text_data=html)
+    def update_chat_status(self):
+        presence_broadcasts.schedule(f"chat-status:{self.chatroom_name}", self.broadcast_chat_status)
+
+    async def broadcast_chat_status(self):
+        online_user_ids = await redis_utils.aget_online_users(self.chatroom_name)
+        event = chat_status_event(self.chatroom_name, online_user_ids)
+        if self.chatroom_name == 'public-chat':
+            # Every header lists the public chat
+            await self.channel_layer.group_send('online-status', event)
+        else:
+            # Only members list this room, so only they hear about it
+            async for member_id in self.chatroom.members.values_list('id', flat=True):
+                await self.channel_layer.group_send(f'user-{member_id}', event)
 
-class OnlineStatusConsumer(WebsocketConsumer):
-    def connect(self):
+class OnlineStatusConsumer(OutboundMixin, PresenceMixin, AsyncWebsocketConsumer):
+    @timed_event('online_status_connect')
+    async def connect(self):
         # Check if user is authenticated first
         if not self.scope["user"].is_authenticated:
-            self.close()
+            await self.close()
             return
-            
+
         self.user = self.scope['user']
         self.group_name = 'online-status'
-        self.group = get_object_or_404(ChatRoom, group_name=self.group_name)
+        self.user_group_name = f'user-{self.user.id}'
 
-        if self.user not in self.group.users_online.all():
-            self.group.users_online.add(self.user)
+        became_online = await self.join_presence(self.group_name)
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.group_name,
             self.channel_name
         )
+        await self.channel_layer.group_add(
+            self.user_group_name,
+            self.channel_name
+        )
 
-        self.accept()
-        self.online_status()
+        await self.accept_protocol()
+        socket_opened('online_status', 'site')
+        # The full widget only goes to this socket; everyone else gets small deltas
+        html = await self.render_online_status()
+        if self.protocol:
+            await self.send_frame({'type': 'html', 'html': html})
+        else:
+            await self.send_frame(html)
+        if became_online:
+            self.update_online_users()
 
-    def disconnect(self, close_code):
+    @timed_event('online_status_disconnect')
+    async def disconnect(self, close_code):
+        self.close_outbox()
         # Only process if user was authenticated and connected successfully
-        if hasattr(self, 'user') and hasattr(self, 'group') and self.user in self.group.users_online.all():
-            self.group.users_online.remove(self.user)
+        went_offline = await self.leave_presence()
 
         if hasattr(self, 'group_name'):
-            async_to_sync(self.channel_layer.group_discard)(
+            socket_closed('online_status', 'site')
+            await self.channel_layer.group_discard(
                 self.group_name,
                 self.channel_name
             )
-            self.online_status()
+            await self.channel_layer.group_discard(
+                self.user_group_name,
+                self.channel_name
+            )
+            if went_offline:
+                self.update_online_users()
+
+    def update_online_users(self):
+        presence_broadcasts.schedule(self.group_name, self.broadcast_online_users)
+
+    async def broadcast_online_users(self):
+        online_count = await redis_utils.aget_online_count(self.group_name) - 1  # Exclude the viewer
+        await self.channel_layer.group_send(self.group_name, online_users_event(online_count))
+
+    @timed_event('online_users_handler')
+    async def online_users_handler(self, event):
+        if self.protocol:
+            frame = {'type': 'online_users', 'count': event['online_count']}
+        else:
+            frame = event['html']
+        await self.send_frame(frame, key='online_users')
+
+    @timed_event('chat_status_handler')
+    async def chat_status_handler(self, event):
+        # Track the rooms with someone else in them so the header dot needs no queries
+        if others_online(event, self.user.id):
+            self.online_chats.add(event['chatroom_name'])
+        else:
+            self.online_chats.discard(event['chatroom_name'])
 
-    def online_status(self):
-        event = {
-            'type': 'online_status_handler',
+        key = f"chat_status:{event['chatroom_name']}"
+        if self.protocol:
+            await self.send_frame({
+                'type': 'chat_status',
+                'chatroom_name': event['chatroom_name'],
+                'online': event['chatroom_name'] in self.online_chats,
+                'online_in_chats': bool(self.online_chats),
+            }, key=key)
+            return
+
+        context = {
+            'chatroom_name': event['chatroom_name'],
+            'online_chats': self.online_chats,
+            'online_in_chats': bool(self.online_chats),
         }
-        async_to_sync(self.channel_layer.group_send)(
-            self.group_name,
-            event
-        )
+        html = render_to_string("monkeychat/partials/chat_status_dot.html", context)
+        html += render_to_string("monkeychat/partials/online_in_chats.html", context)
+        await self.send_frame(html, key=key)
 
-    def online_status_handler(self, event):
-        online_users = self.group.users_online.exclude(id=self.user.id)  # Exclude current user
-        public_chat_users = ChatRoom.objects.get(group_name='public-chat').users_online.exclude(id=self.user.id)  # Exclude current user
-        
-        my_chats = self.user.chat_groups.all()
-        private_chats_with_users = [chat for chat in my_chats.filter(is_private=True) if chat.users_online.exclude(id=self.user.id)]
-        group_chats_with_users = [chat for chat in my_chats.filter(groupchat_name__isnull=False) if chat.users_online.exclude(id=self.user.id)]
+    @database_sync_to_async
+    def render_online_status(self):
+        online_users = redis_utils.get_online_users(self.group_name, exclude_user_id=self.user.id)  # Exclude current user
 
-        if public_chat_users or private_chats_with_users or group_chats_with_users:
-            online_in_chats = True
-        else: 
-            online_in_chats = False    
+        # Chats where someone other than the current user is online
+        chat_list = get_chat_list(self.user)
+        online_counts = redis_utils.get_chat_online_counts(chat_list.chatroom_names, exclude_user_id=self.user.id)
+        self.online_chats = {chat_name for chat_name, count in online_counts.items() if count > 0}
 
         context = {
-            'online_users': online_users,
-            'online_in_chats': online_in_chats,
-            'public_chat_users': public_chat_users,
+            'online_count': len(online_users),
+            'online_in_chats': bool(self.online_chats),
+            'online_chats': self.online_chats,
+            'chat_list': chat_list,
             'user': self.user,
         }
-        html = render_to_string("monkeychat/partials/online_status.html", context=context)
-        self.send(text_data=html)
\ No newline at end of file
+        return render_to_string("monkeychat/partials/online_status.html", context=context)
@@ -0,0 +1,135 @@
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from . import redis_utils
+from .fragments import render_messages
+from .protocol import message_data
+from monkeyusers.models import fallback_identity, get_identities
+
+MESSAGE_TEMPLATE = "monkeychat/partials/chat_message_p.html"
+SYNC_TEMPLATE = "monkeychat/partials/sync_messages.html"
+ONLINE_COUNT_TEMPLATE = "monkeychat/partials/online_count.html"
+ONLINE_USERS_TEMPLATE = "monkeychat/partials/online_user_count.html"
+RECENT_AUTHORS_LIMIT = 30
+
+
+def _recent_authors_key(chatroom_name):
+    return f"chat-authors:{chatroom_name}"
+
+
+def recent_author_ids(chat_group):
+    """Authors of the latest messages in a room, cached until a new author posts"""
+    key = _recent_authors_key(chat_group.group_name)
+    author_ids = cache.get(key)
+    if author_ids is None:
+        recent = chat_group.chat_messages.values_list('author_id', flat=True)[:RECENT_AUTHORS_LIMIT]
+        author_ids = sorted(set(recent))
+        cache.set(key, author_ids, None)
+    return author_ids
+
+
+def note_message_author(chatroom_name, author_id):
+    # Only a new face changes the strip; regulars posting again keep the cache warm
+    author_ids = cache.get(_recent_authors_key(chatroom_name))
+    if author_ids is not None and author_id not in author_ids:
+        cache.delete(_recent_authors_key(chatroom_name))
+
+
+def message_event(message, chat_group):
+    """Build the channel layer event for a new chat message.
+
+    The partial is rendered once as the author sees it and once as everyone
+    else sees it, so each socket in the group only has to pick a variant
+    instead of fetching and rendering the message again. Sockets on a compact
+    protocol forward 'data' instead.
+    """
+    author_online = redis_utils.is_user_online(chat_group.group_name, message.author_id)
+    context = {
+        'message': message,
+        'chat_group': chat_group,
+        'author_online': author_online,
+    }
+    return {
+        'type': 'message_handler',
+        'message_id': message.id,
+        'author_id': message.author_id,
+        'author_online': author_online,
+        'html_own': render_to_string(MESSAGE_TEMPLATE, {**context, 'user': message.author}),
+        'html_other': render_to_string(MESSAGE_TEMPLATE, {**context, 'user': None}),
+        'data': _message_data(message),
+    }
+
+
+def messages_data(messages):
+    """Compact protocol data for messages, with their authors looked up in one query"""
+    authors = get_identities(message.author_id for message in messages)
+    # An author deleted since the message was sent must not break the whole batch
+    return [message_data(message, authors.get(message.author_id) or fallback_identity()) for message in messages]
+
+
+def _message_data(message):
+    return messages_data([message])[0]
+
+
+def message_update_event(message, chat_group):
+    """Build the event that replaces an already broadcast message in place.
+
+    Sent when a message changes after it went out, such as an attachment
+    finishing its upload. Sockets swap the new <li> in by its id.
+    """
+    return {
+        'type': 'message_update_handler',
+        'message_id': message.id,
+        'author_id': message.author_id,
+        'html_own': render_messages([message], message.author)[0],
+        'html_other': render_messages([message], None)[0],
+        'data': _message_data(message),
+    }
+
+
+def online_count_event(chat_group, online_count):
+    """Build the channel layer event for a room's online count.
+
+    Nothing in the partial depends on who is looking at it, so it is rendered
+    once by the sender and every socket forwards the same HTML.
+    """
+    online_user_ids = redis_utils.get_online_users(chat_group.group_name)
+    context = {
+        'online_count': online_count,
+        'online_user_ids': online_user_ids,
+        'chat_group': chat_group,
+        'members': chat_group.members.select_related('profile'),
+        'author_ids': recent_author_ids(chat_group),
+    }
+    return {
+        'type': 'online_count_handler',
+        'online_count': online_count,
+        'online_user_ids': list(online_user_ids),
+        'html': render_to_string(ONLINE_COUNT_TEMPLATE, context),
+    }
+
+
+def online_users_event(online_count):
+    """Build the event for the site-wide online counter in the header"""
+    return {
+        'type': 'online_users_handler',
+        'online_count': online_count,
+        'html': render_to_string(ONLINE_USERS_TEMPLATE, {'online_count': online_count}),
+    }
+
+
+def chat_status_event(chatroom_name, online_user_ids):
+    """Build a presence delta for the header chat lists.
+
+    A viewer only needs to know whether anyone other than themselves is in the
+    room, and two ids are always enough to answer that.
+    """
+    return {
+        'type': 'chat_status_handler',
+        'chatroom_name': chatroom_name,
+        'online_count': len(online_user_ids),
+        'online_user_ids': list(online_user_ids)[:2],
+    }
+
+
+def others_online(event, user_id):
+    return any(online_id != user_id for online_id in event['online_user_ids'])
@@ -0,0 +1,69 @@
+import uuid
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from monkeyusers.models import fallback_identity, get_identities
+
+# Rendered chat_message.html fragments, shared by chat_view, older message
+# pages and WebSocket broadcasts. A fragment only depends on the message, the
+# author's profile and whether the viewer is the author, so it is keyed by
+# message id and upload status, the author's profile version and that
+# own/other variant.
+#
+# Editing a profile or username gives the author a new version, which orphans
+# their old fragments instead of hunting them down; they age out with the TTL.
+MESSAGE_FRAGMENT_TEMPLATE = "monkeychat/chat_message.html"
+FRAGMENT_TTL = 60 * 60 * 24
+
+
+def _profile_version_key(user_id):
+    return f"profile-version:{user_id}"
+
+
+def _fragment_key(message, variant, version):
+    return f"chat-fragment:{message.id}:{message.upload_status}:{variant}:{version}"
+
+
+def _new_version():
+    # Random rather than a counter, so an evicted version never comes back
+    # and revives fragments rendered from an older profile
+    return uuid.uuid4().hex[:12]
+
+
+def profile_versions(user_ids):
+    keys = {user_id: _profile_version_key(user_id) for user_id in set(user_ids)}
+    found = cache.get_many(keys.values())
+    missing = {key: _new_version() for key in keys.values() if key not in found}
+    for key, version in missing.items():
+        cache.add(key, version, None)
+    if missing:
+        found.update(cache.get_many(missing.keys()))
+    return {user_id: found.get(key, missing.get(key)) for user_id, key in keys.items()}
+
+
+def bump_profile_version(user_id):
+    cache.set(_profile_version_key(user_id), _new_version(), None)
+
+
+def render_messages(messages, user):
+    """Rendered fragments for messages as user sees them, in the same order"""
+    messages = list(messages)
+    versions = profile_versions(message.author_id for message in messages)
+    user_id = user.id if user else None
+    keys = [
+        _fragment_key(message, 'own' if message.author_id == user_id else 'other', versions[message.author_id])
+        for message in messages
+    ]
+    cached = cache.get_many(keys)
+    misses = [(message, key) for message, key in zip(messages, keys) if key not in cached]
+    rendered = {}
+    if misses:
+        # One lookup for every author still to render, instead of a profile join per message
+        identities = get_identities(message.author_id for message, _ in misses)
+        for message, key in misses:
+            author = identities.get(message.author_id) or fallback_identity()
+            context = {'message': message, 'author': author, 'user': user}
+            rendered[key] = render_to_string(MESSAGE_FRAGMENT_TEMPLATE, context)
+    if rendered:
+        cache.set_many(rendered, FRAGMENT_TTL)
+        cached.update(rendered)
+    return [cached[key] for key in keys]
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.db.models import Q
+from .recent import RECENT_MESSAGES_LIMIT, get_recent_messages, seed_messages
+from .writebehind import merge_queued
+
+# A reconnecting socket sends the cursor of the newest message it has and is
+# sent what it missed. Past SYNC_REPLAY_LIMIT it gets the latest page instead,
+# replacing its message list the way a page reload would.
+SYNC_REPLAY_LIMIT = getattr(settings, 'CHAT_SYNC_REPLAY_LIMIT', 50)
+
+
+def latest_messages(chat_group):
+    """The newest page of a room's messages, newest first"""
+    # Warm rooms come from the recent messages ring without touching the database
+    messages = get_recent_messages(chat_group)
+    if messages is None:
+        messages = list(chat_group.chat_messages.all()[:RECENT_MESSAGES_LIMIT])
+        seed_messages(chat_group, messages)
+    return merge_queued(chat_group, messages, RECENT_MESSAGES_LIMIT)
+
+
+def missed_messages(chat_group, position):
+    """Messages after a (created, id) position, newest first.
+
+    position is None when the client had no messages at all. Returns None
+    when more than SYNC_REPLAY_LIMIT were missed.
+    """
+    recent = get_recent_messages(chat_group)
+    if recent is not None and position is not None and (
+        len(recent) < RECENT_MESSAGES_LIMIT or (recent[-1].created, recent[-1].id) <= position
+    ):
+        # The ring reaches back to the client's position, so it holds the whole gap
+        messages = [message for message in recent if (message.created, message.id) > position]
+    else:
+        messages = chat_group.chat_messages.all()
+        if position is not None:
+            created, message_id = position
+            messages = messages.filter(Q(created__gt=created) | Q(created=created, id__gt=message_id))
+        messages = list(messages[:SYNC_REPLAY_LIMIT + 1])
+    messages = merge_queued(chat_group, messages, SYNC_REPLAY_LIMIT + 1, after=position)
+    if len(messages) > SYNC_REPLAY_LIMIT:
+        return None
+    return messages
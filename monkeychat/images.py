@@ -0,0 +1,111 @@
+import logging
+import os
+import tempfile
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils.module_loading import import_string
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+logger = logging.getLogger(__name__)
+
+# Small variants of uploaded images, so message rows and avatar circles do not
+# download and decode full-size originals. Variants are WebP, or JPEG when
+# Pillow was built without WebP support.
+#
+# Files go through the configured upload backend into a folder per use, so
+# chat attachments and avatars share the storage code but not a prefix.
+UPLOAD_BACKEND = getattr(settings, 'CHAT_UPLOAD_BACKEND', 'monkeychat.images.StorageBackend')
+CHAT_THUMBNAIL_SIZE = (480, 480)  # Bounding box for images shown inline in chat
+AVATAR_THUMBNAIL_SIZE = (128, 128)  # Square crop; avatar circles are at most 56px, so this covers 2x screens
+THUMBNAIL_QUALITY = 80
+
+if features.check('webp'):
+    THUMBNAIL_FORMAT, THUMBNAIL_EXTENSION = 'WEBP', '.webp'
+else:
+    THUMBNAIL_FORMAT, THUMBNAIL_EXTENSION = 'JPEG', '.jpg'
+
+
+def probe_image(source):
+    """(MIME type, width, height) read from an image's header, or None if it is not one.
+
+    source is a path or a file object, which is rewound afterwards.
+    """
+    try:
+        with Image.open(source) as image:
+            return Image.MIME.get(image.format), image.width, image.height
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+    finally:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+
+
+def make_thumbnail(source, size, crop=False):
+    """Write a thumbnail of source (a path or file object) to a temp file.
+
+    Returns (path, width, height), or None when there is nothing worth
+    making: not an image Pillow can read, animated, or already small enough.
+    The caller removes the file.
+    """
+    try:
+        with Image.open(source) as image:
+            if getattr(image, 'is_animated', False):
+                return None  # A still frame would break GIFs
+            if not crop and image.width <= size[0] and image.height <= size[1]:
+                return None
+            image = ImageOps.exif_transpose(image)
+            if crop:
+                image = ImageOps.fit(image, size, Image.LANCZOS)
+            else:
+                image.thumbnail(size, Image.LANCZOS)
+            if THUMBNAIL_FORMAT == 'JPEG' or image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGB' if THUMBNAIL_FORMAT == 'JPEG' else 'RGBA')
+            with tempfile.NamedTemporaryFile(suffix=THUMBNAIL_EXTENSION, delete=False) as tmp:
+                image.save(tmp, THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+            return tmp.name, image.width, image.height
+    except (UnidentifiedImageError, OSError, ValueError) as e:
+        logger.warning(f"Could not make a thumbnail: {e}")
+        return None
+
+
+def thumbnail_filename(filename):
+    return f'{os.path.splitext(filename)[0]}_thumb{THUMBNAIL_EXTENSION}'
+
+
+class CloudinaryBackend:
+    def upload(self, path, filename, folder):
+        import cloudinary.uploader
+        # path is a temp file, so name the asset after the file the user sent
+        result = cloudinary.uploader.upload(path, resource_type='auto', folder=folder,
+                                            use_filename=True, filename_override=filename)
+        return result['secure_url']
+
+
+class StorageBackend:
+    """Saves to Django's default storage; with FileSystemStorage this is the local stand-in"""
+
+    def upload(self, path, filename, folder):
+        with open(path, 'rb') as f:
+            name = default_storage.save(f'{folder}/{filename}', File(f))
+        return default_storage.url(name)
+
+
+def get_backend():
+    return import_string(UPLOAD_BACKEND)()
+
+
+def store_thumbnail(source, size, filename, folder, crop=False, backend=None):
+    """Make a thumbnail of source and upload it.
+
+    Returns (url, width, height), or None when make_thumbnail made nothing.
+    Upload errors are left to the caller.
+    """
+    thumbnail = make_thumbnail(source, size, crop=crop)
+    if thumbnail is None:
+        return None
+    path, width, height = thumbnail
+    try:
+        return (backend or get_backend()).upload(path, thumbnail_filename(filename), folder), width, height
+    finally:
+        os.unlink(path)
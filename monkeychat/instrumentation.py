@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends.django import Template
+
+# Query and template render hooks shared by monkeychat.metrics,
+# monkeychat.profiling and the chat_benchmark command. install() puts one
+# wrapper on every database connection and one timer around Template.render,
+# and both report to every Recorder active in the current context.
+# database_sync_to_async copies the context into its thread, so queries and
+# renders made there reach the recorders of whatever awaited them; nested
+# recordings all see them. Only the outermost render is timed, so fragments
+# rendered inside a page count towards the page.
+active_recorders = ContextVar('chat_recorders', default=())
+render_depth = ContextVar('chat_render_depth', default=0)
+# Called with (template name, seconds) for every outermost render, recording or not
+render_watchers = []
+
+install_lock = threading.Lock()
+installed = False
+
+
+class Recorder:
+    """Counts the queries and template render time reported while it is active"""
+
+    def __init__(self, statements=False):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.render_seconds = 0.0
+        # How often each SQL statement ran, for spotting N+1 loops
+        self.statements = Counter() if statements else None
+
+    def add_query(self, sql, seconds):
+        with self.lock:
+            self.queries += 1
+            self.query_seconds += seconds
+            if self.statements is not None:
+                self.statements[sql] += 1
+
+    def add_render(self, seconds):
+        with self.lock:
+            self.render_seconds += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return self.queries, self.render_seconds
+
+
+def record_query(execute, sql, params, many, context):
+    recorders = active_recorders.get()
+    if not recorders:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        for recorder in recorders:
+            recorder.add_query(sql, elapsed)
+
+
+def add_query_wrapper(sender, connection, **kwargs):
+    # connection_created fires again on every reconnect
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def timed(render):
+    def timed_render(self, context=None, request=None):
+        if render_depth.get() or not (active_recorders.get() or render_watchers):
+            return render(self, context, request)
+        token = render_depth.set(1)
+        start = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            elapsed = time.perf_counter() - start
+            render_depth.reset(token)
+            for recorder in active_recorders.get():
+                recorder.add_render(elapsed)
+            for watcher in render_watchers:
+                watcher(self.origin.template_name, elapsed)
+    return timed_render
+
+
+def install():
+    """Hook every database connection and Template.render; safe to call more than once"""
+    global installed
+    with install_lock:
+        if installed:
+            return
+        installed = True
+        connection_created.connect(add_query_wrapper)
+        for connection in connections.all(initialized_only=True):
+            add_query_wrapper(None, connection)
+        Template.render = timed(Template.render)
+
+
+@contextmanager
+def recording(recorder):
+    """Report queries and renders made in this context to recorder"""
+    install()
+    token = active_recorders.set((*active_recorders.get(), recorder))
+    try:
+        yield recorder
+    finally:
+        active_recorders.reset(token)
+
+
+def watch_renders(watcher):
+    install()
+    render_watchers.append(watcher)
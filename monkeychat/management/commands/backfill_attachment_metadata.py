@@ -0,0 +1,72 @@
+import mimetypes
+import os
+import shutil
+import tempfile
+from urllib.parse import urlparse
+from urllib.request import urlopen
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from monkeychat.models import ChatMessage
+from monkeychat.uploads import attachment_metadata
+
+# What ChatMessage.is_image used to go by before it was stored
+LEGACY_IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.svg']
+FIELDS = ['file_url', 'original_filename', 'content_type', 'file_size', 'image_width', 'image_height', 'is_image']
+
+
+class Command(BaseCommand):
+    help = 'Store content type, size, dimensions and is_image for attachments sent before they were captured on upload'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fetch', action='store_true', help='Download each file to read its size and image dimensions')
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        attachments = ChatMessage.objects.filter(
+            Q(file_url__isnull=False) | (Q(file__isnull=False) & ~Q(file='')),
+            content_type__isnull=True,
+        ).order_by('id')
+
+        batch = []
+        done = 0
+        for message in attachments.iterator(chunk_size=options['batch_size']):
+            try:
+                self.describe(message, options['fetch'])
+            except Exception as e:
+                self.stdout.write(self.style.WARNING(f'⚠️ Skipping message {message.id}: {e}'))
+                continue
+            batch.append(message)
+            if len(batch) >= options['batch_size']:
+                done += self.save(batch)
+                batch = []
+        done += self.save(batch)
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Backfilled metadata for {done} attachments'))
+
+    def describe(self, message, fetch):
+        # Resolving the Cloudinary URL once here is what spares every render from it
+        url = message.attachment_url
+        message.file_url = url
+        if not message.original_filename:
+            message.original_filename = os.path.basename(urlparse(url).path)
+        filename = message.original_filename
+
+        if fetch:
+            with tempfile.TemporaryFile() as tmp:
+                with urlopen(url, timeout=30) as response:
+                    shutil.copyfileobj(response, tmp)
+                size = tmp.tell()
+                tmp.seek(0)
+                metadata = attachment_metadata(tmp, filename, size)
+        else:
+            extension = os.path.splitext(urlparse(url).path)[1].lower()
+            metadata = {
+                'content_type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                'is_image': extension in LEGACY_IMAGE_EXTENSIONS,
+            }
+        for field, value in metadata.items():
+            setattr(message, field, value)
+
+    def save(self, batch):
+        ChatMessage.objects.bulk_update(batch, FIELDS)
+        return len(batch)
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import time
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from monkeychat import routing
+from monkeychat.instrumentation import Recorder, recording
+from monkeychat.models import ChatRoom
+
+FRAME_TIMEOUT = 5  # Seconds to wait for a frame before counting it as lost
+SETTLE_TIME = 0.6  # Longer than the presence broadcast interval, so coalesced frames have gone out
+
+
+def app_for(user, recorder):
+    # Skips the session and auth middleware; the benchmark logs users in directly
+    inner = URLRouter(routing.websocket_urlpatterns)
+
+    async def app(scope, receive, send):
+        # The communicator starts apps in an empty context, so record from in here
+        with recording(recorder):
+            return await inner(dict(scope, user=user), receive, send)
+    return app
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+    return {'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99), 'max_ms': at(1)}
+
+
+class Client:
+    """One browser tab: a chat room socket plus the header's online-status socket"""
+
+    def __init__(self, user, chatroom, recorder):
+        self.user = user
+        self.chatroom = chatroom
+        self.chat = WebsocketCommunicator(app_for(user, recorder), f'/ws/chatroom/{chatroom.group_name}')
+        self.status = WebsocketCommunicator(app_for(user, recorder), '/ws/online-status/')
+
+    @property
+    def sockets(self):
+        return [self.chat, self.status]
+
+
+async def next_frame(communicator, token=None, timeout=FRAME_TIMEOUT):
+    """Arrival time of the next frame (containing token, if given), or None on timeout.
+
+    Reads the output queue directly: receive_from cancels the app on timeout.
+    """
+    deadline = time.perf_counter() + timeout
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return None
+        try:
+            frame = await asyncio.wait_for(communicator.output_queue.get(), remaining)
+        except asyncio.TimeoutError:
+            return None
+        if token is None or token in frame.get('text', ''):
+            return time.perf_counter()
+
+
+async def settle(clients):
+    await asyncio.sleep(SETTLE_TIME)
+    for client in clients:
+        for socket in client.sockets:
+            while not socket.output_queue.empty():
+                socket.output_queue.get_nowait()
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test ChatroomConsumer and OnlineStatusConsumer against a throwaway test database. '
+        'Reports fan-out latency percentiles, queries and template render time per event as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=3, help='Number of group chat rooms (M)')
+        parser.add_argument('--clients', type=int, default=10, help='Connected clients per room (N)')
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent in each room')
+        parser.add_argument('--redis', metavar='URL', help='Use a Redis channel layer at URL instead of the in-memory one')
+        parser.add_argument('--output', default='chat_benchmark.json', help='Where to write the JSON report')
+
+    def handle(self, *args, **options):
+        if options['redis']:
+            from channels_redis.core import RedisChannelLayer
+            layer = RedisChannelLayer(hosts=[options['redis']])
+        else:
+            layer = InMemoryChannelLayer()
+        old_layer = channel_layers.set(DEFAULT_CHANNEL_LAYER, layer)
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            users, chatrooms = self.create_fixtures(options['rooms'], options['clients'])
+            phases = asyncio.run(self.run(users, chatrooms, options['messages'], Recorder()))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            channel_layers.set(DEFAULT_CHANNEL_LAYER, old_layer)
+
+        report = {
+            'config': {
+                'rooms': options['rooms'],
+                'clients_per_room': options['clients'],
+                'messages_per_room': options['messages'],
+                'channel_layer': type(layer).__name__,
+                'database': connection.vendor,
+            },
+            'phases': phases,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+        for name, phase in phases.items():
+            latency = phase['latency']
+            self.stdout.write(
+                f"{name:<10} events={phase['events']:<5} p50={latency.get('p50_ms')}ms "
+                f"p99={latency.get('p99_ms')}ms queries/event={phase['queries_per_event']} "
+                f"render/event={phase['render_ms_per_event']}ms lost={phase['lost_frames']}"
+            )
+        self.stdout.write(self.style.SUCCESS(f"✅ Report written to {options['output']}"))
+
+    def create_fixtures(self, room_count, client_count):
+        users = [User.objects.create_user(f'bench{i}', f'bench{i}@example.com') for i in range(client_count)]
+        ChatRoom.objects.get_or_create(group_name='public-chat')
+        chatrooms = []
+        for i in range(room_count):
+            chatroom = ChatRoom.objects.create(group_name=f'bench-room-{i}', groupchat_name=f'Bench room {i}')
+            chatroom.members.add(*users)
+            chatrooms.append(chatroom)
+        return users, chatrooms
+
+    async def run(self, users, chatrooms, message_count, recorder):
+        rooms = {chatroom.id: [Client(user, chatroom, recorder) for user in users] for chatroom in chatrooms}
+        clients = [client for room_clients in rooms.values() for client in room_clients]
+        phases = {}
+
+        # Connect: both sockets, until the header's first frame arrives
+        latencies, lost = [], 0
+        before = recorder.snapshot()
+        for client in clients:
+            start = time.perf_counter()
+            for socket in client.sockets:
+                connected, _ = await socket.connect()
+                assert connected, f'{client.user} could not connect'
+            arrived = await next_frame(client.status)
+            if arrived is None:
+                lost += 1
+            else:
+                latencies.append(arrived - start)
+        await settle(clients)
+        phases['connect'] = self.phase(len(clients), latencies, lost, before, recorder)
+
+        # Messages: time from send until each socket in the room has the message
+        latencies, lost = [], 0
+        before = recorder.snapshot()
+        for i in range(message_count):
+            for chatroom in chatrooms:
+                room_clients = rooms[chatroom.id]
+                token = f'bench-{chatroom.id}-{i}'
+                start = time.perf_counter()
+                await room_clients[i % len(room_clients)].chat.send_to(text_data=json.dumps({'body': token}))
+                arrivals = await asyncio.gather(*[next_frame(client.chat, token) for client in room_clients])
+                latencies += [arrived - start for arrived in arrivals if arrived is not None]
+                lost += arrivals.count(None)
+        await settle(clients)
+        phases['message'] = self.phase(message_count * len(chatrooms), latencies, lost, before, recorder)
+
+        # Disconnect, including the presence broadcasts it triggers
+        latencies = []
+        before = recorder.snapshot()
+        for client in clients:
+            start = time.perf_counter()
+            for socket in client.sockets:
+                await socket.disconnect()
+            latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(SETTLE_TIME)
+        phases['disconnect'] = self.phase(len(clients), latencies, 0, before, recorder)
+        return phases
+
+    def phase(self, events, latencies, lost, before, recorder):
+        queries, render_seconds = recorder.snapshot()
+        queries -= before[0]
+        render_seconds -= before[1]
+        return {
+            'events': events,
+            'latency': percentiles(latencies),
+            'lost_frames': lost,
+            'queries': queries,
+            'queries_per_event': round(queries / events, 2) if events else 0,
+            'render_ms': round(render_seconds * 1000, 3),
+            'render_ms_per_event': round(render_seconds * 1000 / events, 3) if events else 0,
+        }
@@ -0,0 +1,15 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from monkeychat.uploads import STALE_UPLOAD_AGE, fail_stale_uploads
+
+
+class Command(BaseCommand):
+    help = 'Mark attachments still pending after a restart failed, so their placeholders stop waiting'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--minutes', type=int, default=STALE_UPLOAD_AGE // timedelta(minutes=1),
+                            help='Only fail uploads pending for longer than this')
+
+    def handle(self, *args, **options):
+        failed = fail_stale_uploads(timedelta(minutes=options['minutes']))
+        self.stdout.write(self.style.SUCCESS(f'✅ Marked {failed} stale uploads failed'))
@@ -0,0 +1,174 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse
+from .instrumentation import Recorder, recording, watch_renders
+
+# In-process metrics for the chat hot paths, exposed in Prometheus text format
+# by metrics_view. Each process keeps its own numbers, so scrape every daphne
+# process. Recording is a lock, a bisect and a few additions, cheap enough to
+# leave on; set CHAT_METRICS = False to turn it off.
+#
+# Database queries are counted per event or request by a Recorder from
+# monkeychat.instrumentation, which also reports every template render.
+ENABLED = getattr(settings, 'CHAT_METRICS', True)
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+lock = threading.Lock()
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+class Histogram:
+    def __init__(self, name, help, label_names, buckets):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        with lock:
+            series = self.series.get(labels)
+            if series is None:
+                # Per-bucket counts (cumulated on exposition), then sum
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        for labels, values in sorted(series.items()):
+            label_text = _labels(self.label_names, labels)
+            total = 0
+            for bound, count in zip([*self.buckets, '+Inf'], values):
+                total += count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {total}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {values[-1]}')
+            lines.append(f'{self.name}_count{{{label_text}}} {total}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, label_names):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.series = {}
+
+    def add(self, labels, amount):
+        with lock:
+            value = self.series.get(labels, 0) + amount
+            if value:
+                self.series[labels] = value
+            else:
+                self.series.pop(labels, None)  # Series that fall back to zero are dropped
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        with lock:
+            series = dict(self.series)
+        for labels, value in sorted(series.items()):
+            lines.append(f'{self.name}{{{_labels(self.label_names, labels)}}} {value}')
+        return lines
+
+
+event_seconds = Histogram('chat_event_seconds', 'Time spent handling a consumer event', ('event',), SECONDS_BUCKETS)
+event_queries = Histogram('chat_event_queries', 'Database queries made while handling a consumer event', ('event',), QUERY_BUCKETS)
+request_seconds = Histogram('chat_request_seconds', 'Time spent serving a chat HTTP view', ('view',), SECONDS_BUCKETS)
+request_queries = Histogram('chat_request_queries', 'Database queries made by a chat HTTP view', ('view',), QUERY_BUCKETS)
+render_seconds = Histogram('chat_render_seconds', 'Time spent rendering a template', ('template',), SECONDS_BUCKETS)
+# By kind of room rather than room, so the series stay few however many rooms there are
+active_sockets = Gauge('chat_active_sockets', 'Open WebSocket connections', ('consumer', 'room_kind'))
+
+REGISTRY = [event_seconds, event_queries, request_seconds, request_queries, render_seconds, active_sockets]
+
+
+def observe_render(template_name, seconds):
+    render_seconds.observe((template_name,), seconds)
+
+
+if ENABLED:
+    watch_renders(observe_render)
+
+
+@contextmanager
+def measure(seconds_histogram, queries_histogram, labels):
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    with recording(Recorder()) as recorder:
+        try:
+            yield
+        finally:
+            seconds_histogram.observe(labels, time.perf_counter() - start)
+            queries_histogram.observe(labels, recorder.queries)
+
+
+def timed_event(name):
+    """Decorate an async consumer method to record its latency and queries as event name"""
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            with measure(event_seconds, event_queries, (name,)):
+                return await method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def room_kind(chatroom):
+    if chatroom.is_private:
+        return 'dm'
+    if chatroom.groupchat_name:
+        return 'group'
+    return 'public'
+
+
+def socket_opened(consumer, kind):
+    if ENABLED:
+        active_sockets.add((consumer, kind), 1)
+
+
+def socket_closed(consumer, kind):
+    if ENABLED:
+        active_sockets.add((consumer, kind), -1)
+
+
+class MetricsMiddleware:
+    """Times the monkeychat views and counts their queries"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not ENABLED:
+            return self.get_response(request)
+        start = time.perf_counter()
+        with recording(Recorder()) as recorder:
+            try:
+                return self.get_response(request)
+            finally:
+                elapsed = time.perf_counter() - start
+                match = request.resolver_match
+                if match and match.func.__module__.startswith('monkeychat.'):
+                    request_seconds.observe((match.url_name,), elapsed)
+                    request_queries.observe((match.url_name,), recorder.queries)
+
+
+@staff_member_required
+def metrics_view(request):
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.expose()
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
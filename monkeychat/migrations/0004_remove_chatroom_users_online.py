@@ -0,0 +1,17 @@
+# Generated by Django 5.2.4 on 2026-10-18 15:30
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monkeychat', '0003_alter_chatroom_group_name'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='chatroom',
+            name='users_online',
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.4 on 2026-10-18 15:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monkeychat', '0004_remove_chatroom_users_online'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='chatmessage',
+            options={'ordering': ['-created', '-id']},
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['group', '-created', '-id'], name='chatmessage_group_created_id'),
+        ),
+    ]
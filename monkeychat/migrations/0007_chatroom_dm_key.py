@@ -0,0 +1,42 @@
+# Generated by Django 5.2.4 on 2026-10-18 17:02
+
+from collections import defaultdict
+from django.db import migrations, models
+
+
+def backfill_dm_keys(apps, schema_editor):
+    ChatRoom = apps.get_model('monkeychat', 'ChatRoom')
+    Membership = ChatRoom.members.through
+    members = defaultdict(list)
+    memberships = Membership.objects.filter(chatroom__is_private=True).values_list('chatroom_id', 'user_id')
+    for chatroom_id, user_id in memberships.iterator():
+        members[chatroom_id].append(user_id)
+
+    seen = set()
+    # Oldest room wins if a pair already has duplicates; the others keep their
+    # history but are no longer what get_or_create_chatroom opens
+    for chatroom_id in sorted(members):
+        if len(members[chatroom_id]) != 2:
+            continue
+        low, high = sorted(members[chatroom_id])
+        dm_key = f'{low}:{high}'
+        if dm_key in seen:
+            continue
+        seen.add(dm_key)
+        ChatRoom.objects.filter(id=chatroom_id).update(dm_key=dm_key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monkeychat', '0006_alter_chatmessage_created'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='dm_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_dm_keys, migrations.RunPython.noop),
+    ]
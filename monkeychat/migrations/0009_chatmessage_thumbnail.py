@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monkeychat', '0008_chatmessage_upload_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='thumbnail_url',
+            field=models.URLField(blank=True, max_length=500, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='thumbnail_width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='thumbnail_height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
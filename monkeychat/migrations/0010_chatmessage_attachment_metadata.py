@@ -0,0 +1,55 @@
+# Generated by Django 5.2.4 on 2026-10-18 19:20
+
+from functools import reduce
+from operator import or_
+from django.db import migrations, models
+from django.db.models import Q
+
+# What ChatMessage.is_image used to go by, so past images keep rendering as
+# images; backfill_attachment_metadata fills in the rest
+LEGACY_IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.svg']
+
+
+def mark_images(apps, schema_editor):
+    ChatMessage = apps.get_model('monkeychat', 'ChatMessage')
+    by_extension = reduce(or_, (
+        Q(file_url__iendswith=extension) | Q(file__iendswith=extension)
+        for extension in LEGACY_IMAGE_EXTENSIONS
+    ))
+    ChatMessage.objects.filter(by_extension).update(is_image=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monkeychat', '0009_chatmessage_thumbnail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='content_type',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='file_size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='image_width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='image_height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='is_image',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_images, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+from django.db import migrations
+
+# Full-text index over ChatMessage.body, see monkeychat.search. Triggers keep
+# the SQLite index in step with every insert, update and delete, including the
+# write-behind bulk inserts that skip model signals; Postgres maintains its
+# GIN index itself.
+SQLITE_FORWARDS = [
+    """CREATE VIRTUAL TABLE monkeychat_chatmessage_fts USING fts5(
+        body, content='monkeychat_chatmessage', content_rowid='id'
+    )""",
+    """CREATE TRIGGER monkeychat_chatmessage_fts_insert AFTER INSERT ON monkeychat_chatmessage BEGIN
+        INSERT INTO monkeychat_chatmessage_fts(rowid, body) VALUES (new.id, new.body);
+    END""",
+    """CREATE TRIGGER monkeychat_chatmessage_fts_delete AFTER DELETE ON monkeychat_chatmessage BEGIN
+        INSERT INTO monkeychat_chatmessage_fts(monkeychat_chatmessage_fts, rowid, body) VALUES ('delete', old.id, old.body);
+    END""",
+    """CREATE TRIGGER monkeychat_chatmessage_fts_update AFTER UPDATE OF body ON monkeychat_chatmessage BEGIN
+        INSERT INTO monkeychat_chatmessage_fts(monkeychat_chatmessage_fts, rowid, body) VALUES ('delete', old.id, old.body);
+        INSERT INTO monkeychat_chatmessage_fts(rowid, body) VALUES (new.id, new.body);
+    END""",
+    "INSERT INTO monkeychat_chatmessage_fts(monkeychat_chatmessage_fts) VALUES ('rebuild')",
+]
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER monkeychat_chatmessage_fts_update",
+    "DROP TRIGGER monkeychat_chatmessage_fts_delete",
+    "DROP TRIGGER monkeychat_chatmessage_fts_insert",
+    "DROP TABLE monkeychat_chatmessage_fts",
+]
+POSTGRES_FORWARDS = [
+    """CREATE INDEX chatmessage_body_search ON monkeychat_chatmessage
+        USING GIN (to_tsvector('english', coalesce(body, '')))""",
+]
+POSTGRES_BACKWARDS = [
+    "DROP INDEX chatmessage_body_search",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monkeychat', '0010_chatmessage_attachment_metadata'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARDS, 'postgresql': POSTGRES_FORWARDS}),
+            run({'sqlite': SQLITE_BACKWARDS, 'postgresql': POSTGRES_BACKWARDS}),
+        ),
+    ]
@@ -1,53 +1,109 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone as django_timezone
 import shortuuid
 import os
-from PIL import Image
+from datetime import datetime, timedelta, timezone
 from cloudinary.models import CloudinaryField
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def make_cursor(created, message_id):
+    """Position of a message in its room's history, used to page back from it"""
+    microseconds = (created - EPOCH) // timedelta(microseconds=1)
+    return f'{microseconds}_{message_id}'
+
 
 class ChatRoom(models.Model):
     group_name = models.CharField(max_length=128, unique=True, default=shortuuid.uuid)
     groupchat_name = models.CharField(max_length=128, blank=True, null=True)
     admin = models.ForeignKey(User, related_name='groupchats', blank=True, null=True, on_delete=models.SET_NULL)
-    users_online = models.ManyToManyField(User, related_name='online_in_groups', blank=True)
     members = models.ManyToManyField(User, related_name='chat_groups', blank=True)
     is_private = models.BooleanField(default=False)
+    # "<lower user id>:<higher user id>" for direct messages, so each pair has at most one room
+    dm_key = models.CharField(max_length=64, unique=True, blank=True, null=True, editable=False)
 
     def __str__(self):
         return self.group_name
+
+    @staticmethod
+    def dm_key_for(user, other_user):
+        low, high = sorted([user.id, other_user.id])
+        return f'{low}:{high}'
     
 
 class ChatMessage(models.Model):
+    UPLOAD_READY = 'ready'
+    UPLOAD_PENDING = 'pending'
+    UPLOAD_FAILED = 'failed'
+    UPLOAD_STATUSES = [
+        (UPLOAD_READY, 'Ready'),
+        (UPLOAD_PENDING, 'Pending'),
+        (UPLOAD_FAILED, 'Failed'),
+    ]
+
     group = models.ForeignKey(ChatRoom, related_name='chat_messages', on_delete=models.CASCADE)
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     body = models.CharField(max_length=300, blank=True, null=True)
     file = CloudinaryField('file', resource_type='auto', blank=True, null=True)
     original_filename = models.CharField(max_length=255, blank=True, null=True)
-    created = models.DateTimeField(auto_now_add=True)
+    # Attachments sent through monkeychat.uploads are stored by URL once their background upload finishes
+    file_url = models.URLField(max_length=500, blank=True, null=True)
+    upload_status = models.CharField(max_length=10, choices=UPLOAD_STATUSES, default=UPLOAD_READY)
+    # Attachment metadata, captured once on upload (backfilled by backfill_attachment_metadata)
+    content_type = models.CharField(max_length=100, blank=True, null=True)
+    file_size = models.PositiveBigIntegerField(blank=True, null=True)
+    image_width = models.PositiveIntegerField(blank=True, null=True)
+    image_height = models.PositiveIntegerField(blank=True, null=True)
+    is_image = models.BooleanField(default=False)
+    # Bounded-size variant of an image attachment (see monkeychat.images)
+    thumbnail_url = models.URLField(max_length=500, blank=True, null=True)
+    thumbnail_width = models.PositiveIntegerField(blank=True, null=True)
+    thumbnail_height = models.PositiveIntegerField(blank=True, null=True)
+    # Stamped on creation; not auto_now_add so write-behind batches keep the time a message was sent
+    created = models.DateTimeField(default=django_timezone.now, editable=False)
+
+    @property
+    def attachment_url(self):
+        if self.file_url:
+            return self.file_url
+        elif self.file:
+            return self.file.url
+        return None
 
     @property
     def filename(self):
         if self.original_filename:
             return self.original_filename
-        elif self.file:
-            return os.path.basename(self.file.url)
+        elif self.attachment_url:
+            return os.path.basename(self.attachment_url)
         else:
             return None
 
     def __str__(self):
         if self.body:
             return f'{self.author.username} : {self.body}'
-        elif self.file:
+        elif self.file or self.original_filename:
             return f'{self.author.username} sent a file \"{self.filename}\"'
         return f'{self.author.username} (empty message)'
 
     class Meta:
-        ordering = ['-created']
+        ordering = ['-created', '-id']
+        indexes = [
+            # Serves both the latest-messages query and keyset pagination
+            models.Index(fields=['group', '-created', '-id'], name='chatmessage_group_created_id'),
+        ]
 
     @property
-    def is_image(self):
-        if self.file and self.file.url:
-            ext = os.path.splitext(self.file.url)[1].lower()
-            return ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.svg']
-        return False
+    def cursor(self):
+        return make_cursor(self.created, self.id)
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """Turn a cursor back into (created, id), or None if it is malformed"""
+        try:
+            microseconds, message_id = cursor.split('_')
+            return EPOCH + timedelta(microseconds=int(microseconds)), int(message_id)
+        except (AttributeError, ValueError, OverflowError, OSError):
+            return None
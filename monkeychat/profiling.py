@@ -0,0 +1,49 @@
+import logging
+import time
+from .instrumentation import Recorder, recording
+
+logger = logging.getLogger(__name__)
+
+# Per-request profiling, switched on with CHAT_PROFILING. Every response gets
+# X-Query-Count, X-Duplicate-Queries and X-Template-Ms headers plus a
+# Server-Timing header for browser dev tools, and a log line on this module's
+# logger. Duplicates are statements that ran more than once with the same SQL,
+# whatever their parameters, which is what an N+1 loop looks like. Queries and
+# renders are collected by monkeychat.instrumentation.
+
+
+class RequestProfile(Recorder):
+    def __init__(self):
+        super().__init__(statements=True)
+
+    @property
+    def duplicates(self):
+        return {sql: count for sql, count in self.statements.items() if count > 1}
+
+
+class QueryProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with recording(RequestProfile()) as profile:
+            response = self.get_response(request)
+        total_ms = (time.perf_counter() - start) * 1000
+
+        duplicates = profile.duplicates
+        response['X-Query-Count'] = profile.queries
+        response['X-Duplicate-Queries'] = sum(duplicates.values())
+        response['X-Template-Ms'] = f'{profile.render_seconds * 1000:.1f}'
+        response['Server-Timing'] = (
+            f'db;desc="{profile.queries} queries";dur={profile.query_seconds * 1000:.1f}, '
+            f'tpl;dur={profile.render_seconds * 1000:.1f}, total;dur={total_ms:.1f}'
+        )
+        logger.info(
+            f"{request.method} {request.path} {response.status_code}: {profile.queries} queries "
+            f"({sum(duplicates.values())} duplicated), templates {profile.render_seconds * 1000:.1f}ms, "
+            f"total {total_ms:.1f}ms"
+        )
+        for sql, count in sorted(duplicates.items(), key=lambda item: -item[1]):
+            logger.info(f"  {count}x {sql}")
+        return response
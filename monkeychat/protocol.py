@@ -0,0 +1,62 @@
+import json
+import msgpack
+from django.conf import settings
+
+# Compact WebSocket frames, negotiated per socket with a WebSocket subprotocol.
+# A socket that asks for monkeychat.json or monkeychat.msgpack gets small
+# frames carrying only message and presence data, which the client renders
+# itself (monkeychat/partials/ws_client.html). Sockets that ask for neither,
+# like htmx's ws-connect, keep getting HTML fragments to swap in.
+#
+# Frames are dicts with a 'type': message, message_update, online_count,
+# online_users, chat_status, and html for the one-off header widget.
+JSON_PROTOCOL = 'monkeychat.json'
+MSGPACK_PROTOCOL = 'monkeychat.msgpack'
+PROTOCOLS = {
+    'json': JSON_PROTOCOL,
+    'msgpack': MSGPACK_PROTOCOL,
+}
+
+# Which protocol the pages ask for: 'html' (htmx, the default), 'json' or 'msgpack'
+PAGE_PROTOCOL = PROTOCOLS.get(getattr(settings, 'CHAT_WS_PROTOCOL', 'html'))
+
+
+def choose_protocol(offered):
+    """The first compact protocol the client offered, or None for HTML"""
+    for protocol in offered:
+        if protocol in PROTOCOLS.values():
+            return protocol
+    return None
+
+
+def encode_frame(protocol, frame):
+    """Keyword arguments for AsyncWebsocketConsumer.send"""
+    if protocol == MSGPACK_PROTOCOL:
+        return {'bytes_data': msgpack.packb(frame)}
+    return {'text_data': json.dumps(frame, separators=(',', ':'))}
+
+
+def decode_frame(text_data=None, bytes_data=None):
+    # Clients may send either encoding whatever they negotiated
+    if bytes_data is not None:
+        return msgpack.unpackb(bytes_data)
+    return json.loads(text_data)
+
+
+def message_data(message, author):
+    """What a client needs to render a message, with author as a monkeyusers Identity"""
+    return {
+        'id': message.id,
+        'author_id': message.author_id,
+        'author': {'name': author.name, 'avatar': author.avatar, 'username': author.username},
+        'body': message.body,
+        'upload_status': message.upload_status,
+        'attachment_url': message.attachment_url,
+        'filename': message.filename,
+        'is_image': message.is_image,
+        'thumbnail_url': message.thumbnail_url,
+        'thumbnail_width': message.thumbnail_width,
+        'thumbnail_height': message.thumbnail_height,
+        'created': message.created.isoformat(),
+        'cursor': message.cursor,
+    }
@@ -0,0 +1,224 @@
+import json
+import logging
+import threading
+from datetime import datetime
+import redis
+from django.db import transaction
+from .models import ChatRoom, make_cursor
+from . import redis_utils
+
+logger = logging.getLogger(__name__)
+
+# Ring buffer of the newest messages per room, newest first, so chat_view can
+# render a warm room without touching the message tables. Entries are plain
+# dicts holding everything chat_message.html needs.
+#
+# New messages are always pushed, but a ring only counts as warm once
+# chat_view has seeded it from the database. Seeding merges with whatever was
+# pushed in the meantime, so a message sent between the database read and the
+# seed is not lost. Deleting messages drops the ring of every room they were
+# in and the next page load reseeds it: rooms on ChatRoom delete, and rooms
+# holding the messages of a deleted user or of an admin delete through
+# forget_deleted_messages. There is deliberately no ChatMessage delete signal,
+# which would turn a room's cascade into a query per message.
+RECENT_MESSAGES_LIMIT = 30
+RECENT_MESSAGES_TTL = 60 * 60
+
+
+def _recent_key(chatroom_name):
+    return f"recent:{chatroom_name}"
+
+
+def _ready_key(chatroom_name):
+    return f"recent-ready:{chatroom_name}"
+
+
+def message_to_dict(message):
+    # Authors are looked up when a fragment is rendered (see monkeychat.fragments)
+    return {
+        'id': message.id,
+        'group_id': message.group_id,
+        'author_id': message.author_id,
+        'body': message.body,
+        'attachment_url': message.attachment_url,
+        'upload_status': message.upload_status,
+        'thumbnail_url': message.thumbnail_url,
+        'thumbnail_width': message.thumbnail_width,
+        'thumbnail_height': message.thumbnail_height,
+        'filename': message.filename,
+        'is_image': message.is_image,
+        'created': message.created.isoformat(timespec='microseconds'),
+    }
+
+
+def _merge_entries(entries):
+    # Newest first, one copy per message, capped at the ring size
+    unique = {entry['id']: entry for entry in entries}
+    ordered = sorted(unique.values(), key=lambda entry: (entry['created'], entry['id']), reverse=True)
+    return ordered[:RECENT_MESSAGES_LIMIT]
+
+
+class CachedMessage:
+    """Stands in for a ChatMessage in templates, built from a ring buffer entry"""
+
+    def __init__(self, data):
+        self.id = data['id']
+        self.group_id = data['group_id']
+        self.author_id = data['author_id']
+        self.body = data['body']
+        self.attachment_url = data['attachment_url']
+        self.upload_status = data['upload_status']
+        self.thumbnail_url = data['thumbnail_url']
+        self.thumbnail_width = data['thumbnail_width']
+        self.thumbnail_height = data['thumbnail_height']
+        self.filename = data['filename']
+        self.is_image = data['is_image']
+        self.created = datetime.fromisoformat(data['created'])
+
+    @property
+    def cursor(self):
+        return make_cursor(self.created, self.id)
+
+
+class LocalRecentMessages:
+    """In-process rings for when Redis is not configured or unreachable"""
+
+    def __init__(self):
+        self.rooms = {}
+        self.ready = set()
+        self.lock = threading.Lock()
+
+    def push(self, chatroom_name, entry):
+        with self.lock:
+            self.rooms[chatroom_name] = _merge_entries([entry, *self.rooms.get(chatroom_name, [])])
+
+    def seed(self, chatroom_name, entries):
+        with self.lock:
+            self.rooms[chatroom_name] = _merge_entries([*self.rooms.get(chatroom_name, []), *entries])
+            self.ready.add(chatroom_name)
+
+    def replace(self, chatroom_name, entry):
+        with self.lock:
+            entries = self.rooms.get(chatroom_name, [])
+            self.rooms[chatroom_name] = [entry if old['id'] == entry['id'] else old for old in entries]
+
+    def get(self, chatroom_name):
+        with self.lock:
+            if chatroom_name not in self.ready:
+                return None
+            return list(self.rooms.get(chatroom_name, []))
+
+    def drop(self, chatroom_name):
+        with self.lock:
+            self.rooms.pop(chatroom_name, None)
+            self.ready.discard(chatroom_name)
+
+
+class RedisRecentMessages:
+    def __init__(self, client):
+        self.client = client
+
+    def push(self, chatroom_name, entry):
+        key = _recent_key(chatroom_name)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.lpush(key, json.dumps(entry))
+        pipe.ltrim(key, 0, RECENT_MESSAGES_LIMIT - 1)
+        pipe.expire(key, RECENT_MESSAGES_TTL)
+        pipe.execute()
+
+    def seed(self, chatroom_name, entries):
+        key = _recent_key(chatroom_name)
+
+        def merge(pipe):
+            pushed = [json.loads(item) for item in pipe.lrange(key, 0, -1)]
+            merged = _merge_entries([*pushed, *entries])
+            pipe.multi()
+            pipe.delete(key)
+            if merged:
+                pipe.rpush(key, *[json.dumps(entry) for entry in merged])
+                pipe.expire(key, RECENT_MESSAGES_TTL)
+            pipe.set(_ready_key(chatroom_name), 1, ex=RECENT_MESSAGES_TTL)
+
+        # Retries if a push lands while we merge
+        self.client.transaction(merge, key)
+
+    def replace(self, chatroom_name, entry):
+        key = _recent_key(chatroom_name)
+
+        def swap(pipe):
+            for index, item in enumerate(pipe.lrange(key, 0, -1)):
+                if json.loads(item)['id'] == entry['id']:
+                    pipe.multi()
+                    pipe.lset(key, index, json.dumps(entry))
+                    return
+
+        # Retries if a push shifts the list while we look
+        self.client.transaction(swap, key)
+
+    def get(self, chatroom_name):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.exists(_ready_key(chatroom_name))
+        pipe.lrange(_recent_key(chatroom_name), 0, -1)
+        ready, raw = pipe.execute()
+        if not ready:
+            return None
+        return [json.loads(item) for item in raw]
+
+    def drop(self, chatroom_name):
+        self.client.delete(_recent_key(chatroom_name), _ready_key(chatroom_name))
+
+
+local_recent = LocalRecentMessages()
+
+
+def _call(name, method, chatroom_name, *args):
+    shard = redis_utils.shard_for(chatroom_name)
+    if shard is not None and shard.available():
+        try:
+            result = getattr(RedisRecentMessages(shard.get_client()), method)(chatroom_name, *args)
+            shard.breaker.record_success()
+            return result
+        except redis.RedisError as e:
+            shard.breaker.record_failure(e)
+            logger.error(f"Redis recent messages {name} failed on shard {shard.name}: {e}")
+            return None
+    return getattr(local_recent, method)(chatroom_name, *args)
+
+
+def push_message(message):
+    """Add a new message to its room's ring"""
+    _call('push', 'push', message.group.group_name, message_to_dict(message))
+
+
+def seed_messages(chat_group, messages):
+    """Fill a room's ring from newest-first messages loaded from the database"""
+    _call('seed', 'seed', chat_group.group_name, [message_to_dict(message) for message in messages])
+
+
+def replace_message(message):
+    """Update a message already in its room's ring, such as a finished upload"""
+    _call('replace', 'replace', message.group.group_name, message_to_dict(message))
+
+
+def drop_messages(chatroom_name):
+    _call('drop', 'drop', chatroom_name)
+
+
+def forget_deleted_messages(messages):
+    """Drop the rings of the rooms holding a ChatMessage queryset about to be deleted"""
+    chatroom_names = set(ChatRoom.objects.filter(chat_messages__in=messages).values_list('group_name', flat=True))
+
+    def drop():
+        for chatroom_name in chatroom_names:
+            drop_messages(chatroom_name)
+
+    # After commit, so a page load can't reseed the rows before they are gone
+    transaction.on_commit(drop)
+
+
+def get_recent_messages(chat_group):
+    """Newest-first cached messages for a warm room, or None if it is cold"""
+    entries = _call('get', 'get', chat_group.group_name)
+    if entries is None:
+        return None
+    return [CachedMessage(entry) for entry in _merge_entries(entries)]
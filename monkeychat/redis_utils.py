@@ -1,89 +1,400 @@
 import redis
-import os
+import redis.asyncio
+import asyncio
+import time
+import threading
+import weakref
 import logging
+from django.conf import settings
+from .sharding import HashRing, parse_shards
 
 logger = logging.getLogger(__name__)
 
-# Initialize Redis connection using existing REDISCLOUD_URL
-try:
-    redis_url = os.getenv('REDISCLOUD_URL')
-    if redis_url:
-        r = redis.from_url(redis_url, decode_responses=True)
-        r.ping()  # Test connection
-        REDIS_AVAILABLE = True
-        print(f"✅ REDIS CONNECTED: {redis_url[:50]}...")
-    else:
-        REDIS_AVAILABLE = False
-        print("❌ REDISCLOUD_URL not found")
-except Exception as e:
-    REDIS_AVAILABLE = False
-    print(f"❌ Redis connection failed: {e}")
-
-print(f"REDIS_AVAILABLE: {REDIS_AVAILABLE}")
-
-def add_user_online(chatroom_name, user_id):
-    """Add user to online set for chatroom"""
-    if REDIS_AVAILABLE:
+# Presence is tracked per connection, not per user, so a user with several
+# tabs open stays online until the last one closes. Every connection entry
+# carries an expiry time that the consumer refreshes with heartbeats; entries
+# from sockets that died without a clean disconnect simply age out.
+PRESENCE_TTL = getattr(settings, 'CHAT_PRESENCE_TTL', 90)
+PRESENCE_HEARTBEAT = PRESENCE_TTL / 3
+
+REDIS_MAX_CONNECTIONS = getattr(settings, 'CHAT_REDIS_MAX_CONNECTIONS', 50)
+# Past REDIS_MAX_CONNECTIONS callers wait up to this long for a free connection
+# rather than failing straight away, so a reconnect storm queues instead of
+# opening the breaker. The socket timeouts make a hung Redis fail like a down one.
+REDIS_POOL_TIMEOUT = getattr(settings, 'CHAT_REDIS_POOL_TIMEOUT', 5)
+REDIS_SOCKET_TIMEOUT = getattr(settings, 'CHAT_REDIS_SOCKET_TIMEOUT', 2)
+REDIS_CONNECT_TIMEOUT = getattr(settings, 'CHAT_REDIS_CONNECT_TIMEOUT', 2)
+REDIS_FAILURE_THRESHOLD = getattr(settings, 'CHAT_REDIS_FAILURE_THRESHOLD', 3)
+REDIS_RETRY_AFTER = getattr(settings, 'CHAT_REDIS_RETRY_AFTER', 30)
+
+# Distinct online users per room in a single round trip, without shipping
+# every connection entry back to Django.
+# KEYS: presence keys, ARGV[1]: current time, ARGV[2]: user id to leave out
+ONLINE_COUNTS_SCRIPT = """
+local counts = {}
+for i, key in ipairs(KEYS) do
+    local seen = {}
+    local count = 0
+    for _, member in ipairs(redis.call('ZRANGEBYSCORE', key, ARGV[1], '+inf')) do
+        local user_id = string.match(member, '^([^:]+)')
+        if user_id ~= ARGV[2] and not seen[user_id] then
+            seen[user_id] = true
+            count = count + 1
+        end
+    end
+    counts[i] = count
+end
+return counts
+"""
+
+
+class CircuitBreaker:
+    """Stops calling Redis after repeated failures and tries again later.
+
+    While open every call goes to the in-process fallback. Once retry_after
+    seconds have passed one call is let through; success closes the breaker,
+    another failure keeps it open for a further retry_after.
+    """
+
+    def __init__(self, failure_threshold, retry_after):
+        self.failure_threshold = failure_threshold
+        self.retry_after = retry_after
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.retry_after:
+                # Half-open: push the next attempt back while this one is in flight
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("Redis is reachable again, closing circuit breaker")
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self, error):
+        with self.lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Redis failing ({error}), opening circuit breaker for {self.retry_after}s")
+                self.opened_at = time.monotonic()
+
+
+POOL_OPTIONS = {
+    'decode_responses': True,
+    'max_connections': REDIS_MAX_CONNECTIONS,
+    'timeout': REDIS_POOL_TIMEOUT,
+    'socket_timeout': REDIS_SOCKET_TIMEOUT,
+    'socket_connect_timeout': REDIS_CONNECT_TIMEOUT,
+}
+
+
+class Shard:
+    """One Redis instance, with its own connection pools and circuit breaker"""
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.breaker = CircuitBreaker(REDIS_FAILURE_THRESHOLD, REDIS_RETRY_AFTER)
+        self.pool = None
+        self.async_pools = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def get_client(self):
+        """Redis client sharing one connection pool per process"""
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = redis.BlockingConnectionPool.from_url(self.url, **POOL_OPTIONS)
+        return redis.Redis(connection_pool=self.pool)
+
+    def get_async_client(self):
+        """asyncio Redis client; pools are bound to the event loop that created them"""
+        loop = asyncio.get_running_loop()
+        pool = self.async_pools.get(loop)
+        if pool is None:
+            pool = redis.asyncio.BlockingConnectionPool.from_url(self.url, **POOL_OPTIONS)
+            self.async_pools[loop] = pool
+        return redis.asyncio.Redis(connection_pool=pool)
+
+    def available(self):
+        return self.breaker.allow()
+
+
+# Rooms are spread over CHAT_REDIS_SHARDS with the same ring as the channel layer
+SHARDS = {
+    name: Shard(name, url)
+    for name, url in parse_shards(getattr(settings, 'CHAT_REDIS_SHARDS', [])).items()
+}
+ring = HashRing(SHARDS)
+
+
+def shard_for(chatroom_name):
+    """The Shard holding a room's keys, or None when Redis is not configured"""
+    return SHARDS.get(ring.node_for(chatroom_name))
+
+
+def group_by_shard(chatroom_names):
+    """Split room names into lists that each live on one shard"""
+    groups = {}
+    for chatroom_name in chatroom_names:
+        shard = shard_for(chatroom_name)
+        groups.setdefault(shard and shard.name, []).append(chatroom_name)
+    return list(groups.values())
+
+
+def _presence_key(chatroom_name):
+    return f"presence:{chatroom_name}"
+
+
+def _member(user_id, conn_id):
+    return f"{user_id}:{conn_id}"
+
+
+def _user_ids(members):
+    return {int(member.split(':', 1)[0]) for member in members}
+
+
+class RedisPresence:
+    """Presence stored as one sorted set per room.
+
+    Members are "<user_id>:<connection id>" and scores are expiry timestamps.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def add(self, chatroom_name, user_id, conn_id):
+        key = _presence_key(chatroom_name)
+        now = time.time()
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zrange(key, 0, -1)
+        pipe.zadd(key, {_member(user_id, conn_id): now + PRESENCE_TTL})
+        pipe.expire(key, int(PRESENCE_TTL * 2))
+        _, members, _, _ = pipe.execute()
+        return user_id not in _user_ids(members)
+
+    def remove(self, chatroom_name, user_id, conn_id):
+        key = _presence_key(chatroom_name)
+        now = time.time()
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zrem(key, _member(user_id, conn_id))
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zrange(key, 0, -1)
+        removed, _, members = pipe.execute()
+        return bool(removed) and user_id not in _user_ids(members)
+
+    def heartbeat(self, chatroom_name, user_id, conn_id):
+        key = _presence_key(chatroom_name)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zadd(key, {_member(user_id, conn_id): time.time() + PRESENCE_TTL})
+        pipe.expire(key, int(PRESENCE_TTL * 2))
+        pipe.execute()
+
+    def users(self, chatroom_name):
+        return _user_ids(self.client.zrangebyscore(_presence_key(chatroom_name), time.time(), '+inf'))
+
+    def counts_many(self, chatroom_names, exclude_user_id=None):
+        if not chatroom_names:
+            return {}
+        script = self.client.register_script(ONLINE_COUNTS_SCRIPT)
+        keys = [_presence_key(chatroom_name) for chatroom_name in chatroom_names]
+        counts = script(keys=keys, args=[time.time(), exclude_user_id or ''])
+        return dict(zip(chatroom_names, counts))
+
+
+class AsyncRedisPresence:
+    """redis.asyncio version of RedisPresence for the consumers"""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def add(self, chatroom_name, user_id, conn_id):
+        key = _presence_key(chatroom_name)
+        now = time.time()
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zrange(key, 0, -1)
+            pipe.zadd(key, {_member(user_id, conn_id): now + PRESENCE_TTL})
+            pipe.expire(key, int(PRESENCE_TTL * 2))
+            _, members, _, _ = await pipe.execute()
+        return user_id not in _user_ids(members)
+
+    async def remove(self, chatroom_name, user_id, conn_id):
+        key = _presence_key(chatroom_name)
+        now = time.time()
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.zrem(key, _member(user_id, conn_id))
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zrange(key, 0, -1)
+            removed, _, members = await pipe.execute()
+        return bool(removed) and user_id not in _user_ids(members)
+
+    async def heartbeat(self, chatroom_name, user_id, conn_id):
+        key = _presence_key(chatroom_name)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {_member(user_id, conn_id): time.time() + PRESENCE_TTL})
+            pipe.expire(key, int(PRESENCE_TTL * 2))
+            await pipe.execute()
+
+    async def users(self, chatroom_name):
+        return _user_ids(await self.client.zrangebyscore(_presence_key(chatroom_name), time.time(), '+inf'))
+
+    async def counts_many(self, chatroom_names, exclude_user_id=None):
+        if not chatroom_names:
+            return {}
+        script = self.client.register_script(ONLINE_COUNTS_SCRIPT)
+        keys = [_presence_key(chatroom_name) for chatroom_name in chatroom_names]
+        counts = await script(keys=keys, args=[time.time(), exclude_user_id or ''])
+        return dict(zip(chatroom_names, counts))
+
+
+class LocalPresence:
+    """In-process stand-in used when Redis is not configured or unreachable.
+
+    Only sees sockets handled by this process, which is all there is when
+    running locally with the in-memory channel layer. While Redis is down the
+    consumers' heartbeats keep registering here, and once it recovers the same
+    heartbeats repopulate Redis.
+    """
+
+    def __init__(self):
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def _live_members(self, chatroom_name, now):
+        room = self.rooms.get(chatroom_name, {})
+        for member, expires in list(room.items()):
+            if expires <= now:
+                del room[member]
+        return room
+
+    def add(self, chatroom_name, user_id, conn_id):
+        with self.lock:
+            room = self._live_members(chatroom_name, time.time())
+            was_online = user_id in _user_ids(room)
+            room[_member(user_id, conn_id)] = time.time() + PRESENCE_TTL
+            self.rooms[chatroom_name] = room
+            return not was_online
+
+    def remove(self, chatroom_name, user_id, conn_id):
+        with self.lock:
+            room = self._live_members(chatroom_name, time.time())
+            removed = room.pop(_member(user_id, conn_id), None) is not None
+            return removed and user_id not in _user_ids(room)
+
+    def heartbeat(self, chatroom_name, user_id, conn_id):
+        with self.lock:
+            room = self.rooms.setdefault(chatroom_name, {})
+            room[_member(user_id, conn_id)] = time.time() + PRESENCE_TTL
+
+    def users(self, chatroom_name):
+        with self.lock:
+            return _user_ids(self._live_members(chatroom_name, time.time()))
+
+    def counts_many(self, chatroom_names, exclude_user_id=None):
+        counts = {}
+        for chatroom_name in chatroom_names:
+            user_ids = self.users(chatroom_name)
+            user_ids.discard(exclude_user_id)
+            counts[chatroom_name] = len(user_ids)
+        return counts
+
+
+local_presence = LocalPresence()
+
+
+def _call(name, method, shard_key, *args):
+    """Run a presence method on the shard for shard_key, falling back to this process on failure"""
+    shard = shard_for(shard_key)
+    if shard is not None and shard.available():
         try:
-            r.sadd(f"online:{chatroom_name}", user_id)
-        except Exception as e:
-            logger.error(f"Redis add_user_online failed: {e}")
+            result = getattr(RedisPresence(shard.get_client()), method)(*args)
+            shard.breaker.record_success()
+            return result
+        except redis.RedisError as e:
+            shard.breaker.record_failure(e)
+            logger.error(f"Redis {name} failed on shard {shard.name}: {e}")
+    return getattr(local_presence, method)(*args)
 
-def remove_user_online(chatroom_name, user_id):
-    """Remove user from online set for chatroom"""
-    if REDIS_AVAILABLE:
+
+async def _acall(name, method, shard_key, *args):
+    """Async counterpart of _call for code running on the event loop"""
+    shard = shard_for(shard_key)
+    if shard is not None and shard.available():
         try:
-            r.srem(f"online:{chatroom_name}", user_id)
-        except Exception as e:
-            logger.error(f"Redis remove_user_online failed: {e}")
+            result = await getattr(AsyncRedisPresence(shard.get_async_client()), method)(*args)
+            shard.breaker.record_success()
+            return result
+        except redis.RedisError as e:
+            shard.breaker.record_failure(e)
+            logger.error(f"Redis {name} failed on shard {shard.name}: {e}")
+    return getattr(local_presence, method)(*args)
+
+
+def add_user_online(chatroom_name, user_id, conn_id):
+    """Register a connection; returns True if the user just came online"""
+    return _call('add_user_online', 'add', chatroom_name, chatroom_name, user_id, conn_id)
+
+def remove_user_online(chatroom_name, user_id, conn_id):
+    """Drop a connection; returns True if it was the user's last one"""
+    return _call('remove_user_online', 'remove', chatroom_name, chatroom_name, user_id, conn_id)
+
+def heartbeat(chatroom_name, user_id, conn_id):
+    """Push back the expiry of a live connection"""
+    _call('heartbeat', 'heartbeat', chatroom_name, chatroom_name, user_id, conn_id)
 
 def get_online_count(chatroom_name, exclude_user_id=None):
     """Get count of online users, optionally excluding a user"""
-    if REDIS_AVAILABLE:
-        try:
-            count = r.scard(f"online:{chatroom_name}")
-            if exclude_user_id and r.sismember(f"online:{chatroom_name}", exclude_user_id):
-                count -= 1
-            # print(f"⚡ Redis count for {chatroom_name}: {count}")
-            return count
-        except Exception as e:
-            # print(f"❌ Redis get_online_count failed: {e}")
-            pass
-    # print(f"⚠️ Redis not available, returning 0 for {chatroom_name}")
-    return 0
+    return len(get_online_users(chatroom_name, exclude_user_id))
 
 def get_online_users(chatroom_name, exclude_user_id=None):
     """Get list of online user IDs"""
-    if REDIS_AVAILABLE:
-        try:
-            user_ids = r.smembers(f"online:{chatroom_name}")
-            if exclude_user_id:
-                user_ids.discard(str(exclude_user_id))
-            return [int(uid) for uid in user_ids]
-        except Exception as e:
-            logger.error(f"Redis get_online_users failed: {e}")
-    return []
+    user_ids = _call('get_online_users', 'users', chatroom_name, chatroom_name)
+    user_ids.discard(exclude_user_id)
+    return sorted(user_ids)
 
 def is_user_online(chatroom_name, user_id):
     """Check if user is online in chatroom"""
-    if REDIS_AVAILABLE:
-        try:
-            return r.sismember(f"online:{chatroom_name}", user_id)
-        except Exception as e:
-            logger.error(f"Redis is_user_online failed: {e}")
-    return False
+    return user_id in get_online_users(chatroom_name)
 
 def get_chat_online_counts(chat_names, exclude_user_id=None):
-    """Get online counts for multiple chats efficiently"""
-    if REDIS_AVAILABLE:
-        try:
-            counts = {}
-            for chat_name in chat_names:
-                count = r.scard(f"online:{chat_name}")
-                if exclude_user_id and r.sismember(f"online:{chat_name}", exclude_user_id):
-                    count -= 1
-                counts[chat_name] = count
-            return counts
-        except Exception as e:
-            logger.error(f"Redis get_chat_online_counts failed: {e}")
-    return {chat_name: 0 for chat_name in chat_names}
\ No newline at end of file
+    """Get online counts for multiple chats in one round trip per shard"""
+    counts = {}
+    for names in group_by_shard(chat_names):
+        counts.update(_call('get_chat_online_counts', 'counts_many', names[0], names, exclude_user_id))
+    return counts
+
+
+async def aadd_user_online(chatroom_name, user_id, conn_id):
+    return await _acall('add_user_online', 'add', chatroom_name, chatroom_name, user_id, conn_id)
+
+async def aremove_user_online(chatroom_name, user_id, conn_id):
+    return await _acall('remove_user_online', 'remove', chatroom_name, chatroom_name, user_id, conn_id)
+
+async def aheartbeat(chatroom_name, user_id, conn_id):
+    await _acall('heartbeat', 'heartbeat', chatroom_name, chatroom_name, user_id, conn_id)
+
+async def aget_online_count(chatroom_name, exclude_user_id=None):
+    return len(await aget_online_users(chatroom_name, exclude_user_id))
+
+async def aget_online_users(chatroom_name, exclude_user_id=None):
+    user_ids = await _acall('get_online_users', 'users', chatroom_name, chatroom_name)
+    user_ids.discard(exclude_user_id)
+    return sorted(user_ids)
+
+async def aget_chat_online_counts(chat_names, exclude_user_id=None):
+    counts = {}
+    for names in group_by_shard(chat_names):
+        counts.update(await _acall('get_chat_online_counts', 'counts_many', names[0], names, exclude_user_id))
+    return counts
@@ -0,0 +1,87 @@
+import re
+from django.db import connection
+from .models import ChatMessage
+
+# Full-text search over a room's messages, backed by the index from migration
+# 0011: an FTS5 table kept in step by triggers on SQLite, and a GIN index on
+# to_tsvector('english', body) on Postgres.
+#
+# Results are ranked best first and paged by keyset on (score, id), so the
+# cursor is the score and id of the last result shown. Both backends score
+# lower-is-better: bm25() is already negative, and ts_rank is negated. Messages
+# still waiting in the write-behind queue are found once they are flushed.
+SEARCH_PAGE_SIZE = 20
+
+SQLITE_SEARCH = """
+    SELECT id, score FROM (
+        SELECT message.id AS id, bm25(monkeychat_chatmessage_fts) AS score
+        FROM monkeychat_chatmessage_fts
+        JOIN monkeychat_chatmessage message ON message.id = monkeychat_chatmessage_fts.rowid
+        WHERE monkeychat_chatmessage_fts MATCH %s AND message.group_id = %s
+    ) ranked
+    WHERE score > %s OR (score = %s AND id < %s)
+    ORDER BY score, id DESC
+    LIMIT %s
+"""
+
+POSTGRES_SEARCH = """
+    SELECT id, score FROM (
+        SELECT message.id AS id,
+            -ts_rank(to_tsvector('english', coalesce(message.body, '')), query)::float8 AS score
+        FROM monkeychat_chatmessage message, websearch_to_tsquery('english', %s) query
+        WHERE message.group_id = %s
+            AND to_tsvector('english', coalesce(message.body, '')) @@ query
+    ) ranked
+    WHERE score > %s OR (score = %s AND id < %s)
+    ORDER BY score, id DESC
+    LIMIT %s
+"""
+
+
+def make_search_cursor(score, message_id):
+    return f'{score!r}_{message_id}'
+
+
+def parse_search_cursor(cursor):
+    """Turn a search cursor back into (score, id), or None if it is malformed"""
+    try:
+        score, message_id = cursor.rsplit('_', 1)
+        return float(score), int(message_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _fts5_query(query):
+    # Quote every word so user input can't use FTS5 operators or column filters
+    words = re.findall(r'\w+', query)
+    return ' '.join('"%s"' % word for word in words)
+
+
+def search_messages(chat_group, query, after=None, limit=SEARCH_PAGE_SIZE):
+    """A page of a room's messages matching query, best match first.
+
+    after is a (score, id) position from parse_search_cursor. Returns the
+    messages and the cursor of the next page, or None when there are no more.
+    """
+    if connection.vendor == 'postgresql':
+        sql, terms = POSTGRES_SEARCH, query.strip()
+    else:
+        sql, terms = SQLITE_SEARCH, _fts5_query(query)
+    if not terms:
+        return [], None
+
+    # Every score ranks after -inf, so the first page starts at the top
+    score, message_id = after or (float('-inf'), 0)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [terms, chat_group.id, score, score, message_id, limit + 1])
+        ranked = cursor.fetchall()
+
+    found = ChatMessage.objects.in_bulk([row[0] for row in ranked[:limit]])
+    # Anything deleted between the two queries is skipped
+    messages = [found[row_id] for row_id, row_score in ranked[:limit] if row_id in found]
+
+    next_cursor = None
+    if len(ranked) > limit:
+        last_id, last_score = ranked[limit - 1]
+        next_cursor = make_search_cursor(last_score, last_id)
+    return messages, next_cursor
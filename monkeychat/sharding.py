@@ -0,0 +1,68 @@
+import hashlib
+from bisect import bisect
+from channels_redis.core import RedisChannelLayer
+
+# Rooms are spread over the Redis shards in CHAT_REDIS_SHARDS by consistent
+# hashing. Each shard gets many points on a ring, placed by hashing its name,
+# and a room belongs to the first point after the hash of the room name.
+#
+# Everything is keyed by room name and shard name, never by a shard's place in
+# the list: reordering the list moves nothing, and adding or removing a shard
+# only moves the rooms next to its points, about 1/N of them. A room's channel
+# layer group, presence set and recent messages ring all hash the same way, so
+# they live together on one shard.
+#
+# When a room moves, its presence set on the new shard is rebuilt by the next
+# round of heartbeats, its recent messages ring is reseeded from the database
+# on the next page load, and the old keys expire on their own.
+POINTS_PER_SHARD = 160
+
+
+def _hash(value):
+    if isinstance(value, str):
+        value = value.encode('utf8')
+    return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+
+def parse_shards(entries):
+    """Map shard names to Redis URLs from "name=url" (or bare "url") entries"""
+    shards = {}
+    for entry in entries:
+        name, separator, url = entry.strip().partition('=')
+        if not separator:
+            name = url = entry.strip()
+        shards[name] = url
+    return shards
+
+
+class HashRing:
+    def __init__(self, nodes, points=POINTS_PER_SHARD):
+        self.nodes = list(nodes)
+        ring = sorted((_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(points))
+        self.hashes = [point for point, node in ring]
+        self.owners = [node for point, node in ring]
+
+    def node_for(self, key):
+        if not self.owners:
+            return None
+        return self.owners[bisect(self.hashes, _hash(key)) % len(self.owners)]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """RedisChannelLayer placing groups and channels with the shard ring.
+
+    The stock layer splits CRC32 space evenly between hosts by list position,
+    which moves most groups whenever a host is added. Configure it with
+    "shards" (CHAT_REDIS_SHARDS entries) instead of "hosts".
+    """
+
+    def __init__(self, shards=None, **kwargs):
+        shards = parse_shards(shards or [])
+        super().__init__(hosts=list(shards.values()), **kwargs)
+        self.ring = HashRing(shards)
+        self.shard_index = {name: index for index, name in enumerate(shards)}
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        return self.shard_index[self.ring.node_for(value)]
@@ -0,0 +1,57 @@
+from django.dispatch import receiver
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.contrib.auth.models import User
+from monkeyusers.models import Profile
+from .models import ChatMessage, ChatRoom
+from .events import note_message_author
+from .recent import drop_messages, forget_deleted_messages, push_message
+from .fragments import bump_profile_version
+from .chatlist import forget_chat_lists, forget_room_chat_lists
+
+@receiver(post_save, sender=ChatMessage)
+def chatmessage_postsave(sender, instance, created, **kwargs):
+    if created:
+        note_message_author(instance.group.group_name, instance.author_id)
+        push_message(instance)
+
+def author_changed(user):
+    # Cached fragments carry the author's name, username and avatar
+    bump_profile_version(user.id)
+    # Private chats are listed under the other member's name
+    forget_room_chat_lists(user.chat_groups.values_list('id', flat=True))
+
+@receiver(post_save, sender=Profile)
+def profile_postsave(sender, instance, **kwargs):
+    author_changed(instance.user)
+
+@receiver(post_save, sender=User)
+def user_postsave(sender, instance, created, update_fields, **kwargs):
+    # Logins only touch last_login, which no message shows
+    if not created and (update_fields is None or 'username' in update_fields):
+        author_changed(instance)
+
+@receiver(pre_delete, sender=User)
+def user_predelete(sender, instance, **kwargs):
+    # Their messages go with them in the cascade
+    forget_deleted_messages(ChatMessage.objects.filter(author=instance))
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(pre_delete, sender=ChatRoom)
+def chatroom_changed(sender, instance, signal, **kwargs):
+    forget_room_chat_lists([instance.id])
+    if signal is pre_delete:
+        # Once per room; a post_delete receiver on ChatMessage would turn
+        # the cascade into a query per message
+        drop_messages(instance.group_name)
+
+@receiver(m2m_changed, sender=ChatRoom.members.through)
+def chatroom_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # instance is a user joining or leaving the rooms in pk_set
+        forget_chat_lists([instance.id])
+        forget_room_chat_lists(pk_set or instance.chat_groups.values_list('id', flat=True))
+    else:
+        forget_chat_lists(pk_set or [])
+        forget_room_chat_lists([instance.id])
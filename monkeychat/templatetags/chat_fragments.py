@@ -0,0 +1,29 @@
+from django import template
+from django.utils.safestring import mark_safe
+from ..fragments import render_messages
+from ..protocol import PAGE_PROTOCOL
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def chat_message(context, message):
+    return mark_safe(render_messages([message], context.get('user'))[0])
+
+
+@register.simple_tag(takes_context=True)
+def chat_message_list(context, messages):
+    # Views load newest first; the chat list shows them oldest first
+    return mark_safe(''.join(reversed(render_messages(messages, context.get('user')))))
+
+
+@register.simple_tag(takes_context=True)
+def chat_search_results(context, messages):
+    # Search results keep their ranked order
+    return mark_safe(''.join(render_messages(messages, context.get('user'))))
+
+
+@register.simple_tag
+def chat_ws_protocol():
+    """The compact WebSocket protocol pages should ask for, or '' for htmx's HTML frames"""
+    return PAGE_PROTOCOL or ''
@@ -1,3 +1,831 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import shutil
+import subprocess
+import threading
+import unittest
+from collections import Counter
+from contextlib import contextmanager
+from io import StringIO
+from datetime import timedelta
+from unittest import mock
+import msgpack
+import redis
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.template.loader import render_to_string
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from monkeyusers.models import Identity
+from monkeyusers.signals import django_login_message
+from .coalesce import BroadcastCoalescer, presence_broadcasts
+from .models import ChatRoom, ChatMessage
+from .fragments import render_messages
+from .images import CloudinaryBackend
+from .instrumentation import Recorder, recording
+from .protocol import JSON_PROTOCOL, message_data
+from .recent import CachedMessage, get_recent_messages, local_recent, message_to_dict, replace_message, seed_messages
+from .search import parse_search_cursor, search_messages
+from .sharding import HashRing, ShardedRedisChannelLayer, parse_shards
+from . import redis_utils, routing, writebehind
 
-# Create your tests here.
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class QueryBudgetTestCase(TestCase):
+    """Asserts how many queries a view may make, so N+1 regressions fail here.
+
+    Each view is requested at two data sizes against the same budget: a query
+    per row shows up as the larger size going over. Caches are cleared before
+    every request, so the budget covers the cold path.
+    """
+
+    def setUp(self):
+        # The login message needs a real request; force_login doesn't have one
+        user_logged_in.disconnect(django_login_message)
+        self.addCleanup(user_logged_in.connect, django_login_message)
+        self.user = User.objects.create_user('budget', 'budget@example.com', 'password')
+        self.client.force_login(self.user)
+
+    def make_users(self, count, prefix='member'):
+        return [User.objects.create_user(f'{prefix}{i}', f'{prefix}{i}@example.com') for i in range(count)]
+
+    def clear_caches(self):
+        cache.clear()
+        local_recent.rooms.clear()
+        local_recent.ready.clear()
+
+    @contextmanager
+    def assertQueryBudget(self, budget):
+        with CaptureQueriesContext(connection) as captured:
+            yield captured
+        if len(captured) > budget:
+            statements = Counter(query['sql'] for query in captured.captured_queries)
+            report = '\n'.join(f'  {count}x {sql}' for sql, count in statements.most_common())
+            self.fail(f'{len(captured)} queries, over the budget of {budget}:\n{report}')
+
+    def get_within_budget(self, budget, url, **kwargs):
+        self.clear_caches()
+        with self.assertQueryBudget(budget):
+            response = self.client.get(url, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+
+class ChatViewQueryBudgetTests(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.public_chat = ChatRoom.objects.create(group_name='public-chat')
+
+    def add_messages(self, chatroom, authors, count):
+        for i in range(count):
+            ChatMessage.objects.create(group=chatroom, author=authors[i % len(authors)], body=f'message {i}')
+
+    def test_public_chat(self):
+        authors = [self.user]
+        for size in (2, 30):
+            authors += self.make_users(size - len(authors), prefix=f'author{size}-')
+            self.add_messages(self.public_chat, authors, size)
+            self.get_within_budget(6, '/chat/')
+
+    def test_group_chat(self):
+        chatroom = ChatRoom.objects.create(groupchat_name='Budget', admin=self.user)
+        chatroom.members.add(self.user)
+        for size in (2, 30):
+            members = self.make_users(size, prefix=f'group{size}-')
+            chatroom.members.add(*members)
+            self.add_messages(chatroom, members, size)
+            self.get_within_budget(7, f'/chat/room/{chatroom.group_name}')
+
+    def test_private_chat(self):
+        other_user = User.objects.create_user('other', 'other@example.com')
+        chatroom = ChatRoom.objects.create(is_private=True)
+        chatroom.members.add(self.user, other_user)
+        for size in (2, 30):
+            self.add_messages(chatroom, [self.user, other_user], size)
+            self.get_within_budget(7, f'/chat/room/{chatroom.group_name}')
+
+    def test_older_messages(self):
+        authors = [self.user]
+        for size in (2, 30):
+            authors += self.make_users(size - len(authors), prefix=f'older{size}-')
+            self.add_messages(self.public_chat, authors, size + 20)
+            response = self.get_within_budget(5, '/chat/older/public-chat')
+            self.assertContains(response, 'data-cursor')
+
+    def test_chatroom_edit(self):
+        chatroom = ChatRoom.objects.create(groupchat_name='Budget', admin=self.user)
+        chatroom.members.add(self.user)
+        for size in (2, 30):
+            chatroom.members.add(*self.make_users(size, prefix=f'edit{size}-'))
+            self.get_within_budget(6, f'/chat/edit/{chatroom.group_name}')
+
+    def test_chatroom_edit_removes_members(self):
+        chatroom = ChatRoom.objects.create(groupchat_name='Budget', admin=self.user)
+        chatroom.members.add(self.user)
+        for size in (2, 30):
+            members = self.make_users(size, prefix=f'remove{size}-')
+            chatroom.members.add(*members)
+            self.clear_caches()
+            with self.assertQueryBudget(9):
+                response = self.client.post(f'/chat/edit/{chatroom.group_name}', {
+                    'groupchat_name': 'Budget',
+                    'remove_members': [member.id for member in members],
+                })
+            self.assertRedirects(response, f'/chat/room/{chatroom.group_name}', fetch_redirect_response=False)
+            self.assertEqual(list(chatroom.members.all()), [self.user])
+
+    def test_chatroom_delete(self):
+        for size in (2, 200):
+            chatroom = ChatRoom.objects.create(groupchat_name='Budget', admin=self.user)
+            chatroom.members.add(self.user)
+            self.add_messages(chatroom, [self.user], size)
+            self.clear_caches()
+            # Messages go in one DELETE; a ChatMessage delete signal would load each one
+            with self.assertQueryBudget(8):
+                response = self.client.post(f'/chat/delete/{chatroom.group_name}')
+            self.assertRedirects(response, '/chat/', fetch_redirect_response=False)
+
+    def test_search(self):
+        authors = [self.user]
+        for size in (2, 30):
+            authors += self.make_users(size - len(authors), prefix=f'search{size}-')
+            self.add_messages(self.public_chat, authors, size)
+            response = self.get_within_budget(7, '/chat/search/public-chat?q=message')
+            self.assertContains(response, 'data-cursor')
+
+
+class ChatSearchTests(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.chatroom = ChatRoom.objects.create(groupchat_name='Search', admin=self.user)
+        self.chatroom.members.add(self.user)
+
+    def say(self, body, chatroom=None):
+        return ChatMessage.objects.create(group=chatroom or self.chatroom, author=self.user, body=body)
+
+    def test_ranks_and_pages_matches(self):
+        best = self.say('snowball snowball snowball')
+        others = [self.say(f'a snowball fight number {i}') for i in range(5)]
+        self.say('nothing to see here')
+        self.say('snowball', chatroom=ChatRoom.objects.create(groupchat_name='Elsewhere'))
+
+        seen, after = [], None
+        while True:
+            page, cursor = search_messages(self.chatroom, 'snowball', after, limit=2)
+            seen += page
+            if cursor is None:
+                break
+            after = parse_search_cursor(cursor)
+        self.assertEqual(seen[0], best)
+        self.assertCountEqual(seen, [best] + others)
+
+    def test_index_follows_writes(self):
+        message = self.say('monkey business')
+        ChatMessage.objects.bulk_create([ChatMessage(group=self.chatroom, author=self.user, body='monkey queue')])
+        self.assertEqual(len(search_messages(self.chatroom, 'monkey')[0]), 2)
+        message.body = 'something else'
+        message.save()
+        ChatMessage.objects.filter(body='monkey queue').delete()
+        self.assertEqual(search_messages(self.chatroom, 'monkey'), ([], None))
+
+    def test_query_syntax_is_not_interpreted(self):
+        self.say('body: "quoted" OR NOT')
+        self.assertEqual(len(search_messages(self.chatroom, 'body: "quoted" OR')[0]), 1)
+        self.assertEqual(search_messages(self.chatroom, '*'), ([], None))
+
+    def test_private_rooms_need_membership(self):
+        other_user = User.objects.create_user('other', 'other@example.com')
+        chatroom = ChatRoom.objects.create(is_private=True)
+        chatroom.members.add(other_user, User.objects.create_user('third', 'third@example.com'))
+        self.say('secret plans', chatroom=chatroom)
+        response = self.client.get(f'/chat/search/{chatroom.group_name}?q=secret')
+        self.assertEqual(response.status_code, 404)
+        chatroom.members.add(self.user)
+        self.assertContains(self.client.get(f'/chat/search/{chatroom.group_name}?q=secret'), 'secret plans')
+
+    def test_bad_cursor(self):
+        response = self.client.get(f'/chat/search/{self.chatroom.group_name}?q=snow&after=nope')
+        self.assertEqual(response.status_code, 400)
+
+
+class DirectMessageTests(QueryBudgetTestCase):
+    def setUp(self):
+        super().setUp()
+        self.friend = User.objects.create_user('friend', 'friend@example.com')
+        self.dm_key = ChatRoom.dm_key_for(self.user, self.friend)
+
+    def test_start_chat_reuses_the_room(self):
+        first = self.client.get('/chat/friend')
+        chatroom = ChatRoom.objects.get(dm_key=self.dm_key)
+        self.assertRedirects(first, f'/chat/room/{chatroom.group_name}', fetch_redirect_response=False)
+        self.assertRedirects(self.client.get('/chat/friend'), f'/chat/room/{chatroom.group_name}', fetch_redirect_response=False)
+        self.assertEqual(list(chatroom.members.order_by('id')), [self.user, self.friend])
+
+    def test_room_created_at_the_same_moment(self):
+        # The friend's request inserts the room after this one looked for it
+        theirs = ChatRoom.objects.create(is_private=True, dm_key=self.dm_key)
+        theirs.members.add(self.user, self.friend)
+        with mock.patch.object(ChatRoom.objects, 'filter', return_value=ChatRoom.objects.none()):
+            response = self.client.get('/chat/friend')
+        self.assertRedirects(response, f'/chat/room/{theirs.group_name}', fetch_redirect_response=False)
+        self.assertEqual(list(ChatRoom.objects.filter(is_private=True)), [theirs])
+        self.assertEqual(theirs.members.count(), 2)
+
+
+class RecentMessagesTests(TestCase):
+    def setUp(self):
+        local_recent.rooms.clear()
+        local_recent.ready.clear()
+        self.user = User.objects.create_user('ringer', 'ringer@example.com')
+        self.chatroom = ChatRoom.objects.create(group_name='ring')
+
+    def test_finished_upload_replaces_its_entry(self):
+        other = ChatMessage.objects.create(group=self.chatroom, author=self.user, body='hello')
+        pending = ChatMessage.objects.create(group=self.chatroom, author=self.user, original_filename='pic.png',
+                                             upload_status=ChatMessage.UPLOAD_PENDING)
+        seed_messages(self.chatroom, [pending, other])
+        pending.upload_status = ChatMessage.UPLOAD_READY
+        pending.file_url = 'https://example.com/pic.png'
+        replace_message(pending)
+        # The ring stays warm, with the finished message in the placeholder's place
+        cached = get_recent_messages(self.chatroom)
+        self.assertEqual([message.id for message in cached], [pending.id, other.id])
+        self.assertEqual((cached[0].upload_status, cached[0].attachment_url), ('ready', 'https://example.com/pic.png'))
+
+    def test_stale_uploads_fail(self):
+        stale = ChatMessage.objects.create(group=self.chatroom, author=self.user, original_filename='lost.png',
+                                           upload_status=ChatMessage.UPLOAD_PENDING,
+                                           created=timezone.now() - timedelta(hours=1))
+        fresh = ChatMessage.objects.create(group=self.chatroom, author=self.user, original_filename='busy.png',
+                                           upload_status=ChatMessage.UPLOAD_PENDING)
+        seed_messages(self.chatroom, [fresh, stale])
+        with mock.patch('monkeychat.uploads.get_channel_layer') as get_channel_layer:
+            get_channel_layer.return_value.group_send = mock.AsyncMock()
+            call_command('fail_stale_uploads', stdout=StringIO())
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((stale.upload_status, fresh.upload_status), ('failed', 'pending'))
+        # Open pages and the ring both swap the placeholder for the failure
+        get_channel_layer.return_value.group_send.assert_called_once()
+        self.assertEqual([message.upload_status for message in get_recent_messages(self.chatroom)], ['pending', 'failed'])
+
+
+    def test_deleted_messages_leave_the_ring(self):
+        other_room = ChatRoom.objects.create(group_name='other-ring')
+        author = User.objects.create_user('leaver', 'leaver@example.com')
+        gone = ChatMessage.objects.create(group=self.chatroom, author=author, body='bye')
+        kept = ChatMessage.objects.create(group=other_room, author=self.user, body='hi')
+        seed_messages(self.chatroom, [gone])
+        seed_messages(other_room, [kept])
+        with self.captureOnCommitCallbacks(execute=True):
+            author.delete()
+        self.assertIsNone(get_recent_messages(self.chatroom))
+        self.assertIsNotNone(get_recent_messages(other_room))
+
+    def test_admin_deletes_leave_the_ring(self):
+        message_admin = admin.site._registry[ChatMessage]
+        for delete in (
+            lambda message: message_admin.delete_model(None, message),
+            lambda message: message_admin.delete_queryset(None, ChatMessage.objects.filter(id=message.id)),
+        ):
+            message = ChatMessage.objects.create(group=self.chatroom, author=self.user, body='oops')
+            seed_messages(self.chatroom, [message])
+            with self.captureOnCommitCallbacks(execute=True):
+                delete(message)
+            self.assertIsNone(get_recent_messages(self.chatroom))
+
+    def test_message_from_deleted_author_renders(self):
+        message = ChatMessage.objects.create(group=self.chatroom, author=self.user, body='still here')
+        entry = message_to_dict(message)
+        entry['author_id'] = 10 ** 6
+        html = render_messages([CachedMessage(entry)], self.user)[0]
+        self.assertIn('Deleted user', html)
+        self.assertIn('still here', html)
+
+
+class WriteBehindTests(TransactionTestCase):
+    # Foreign keys are only checked on commit, so the drop path needs real transactions
+    def setUp(self):
+        self.user = User.objects.create_user('writer', 'writer@example.com')
+        self.chatroom = ChatRoom.objects.create(group_name='write-behind')
+        self.buffer = writebehind.WriteBehindBuffer(interval=1, batch_size=100)
+        self.start = timezone.now()
+
+    def queue(self, count):
+        ids = writebehind.reserve_message_ids(count)
+        messages = [
+            ChatMessage(id=message_id, group=self.chatroom, author=self.user, body=f'queued {i}',
+                        created=self.start + timedelta(microseconds=i))
+            for i, message_id in enumerate(ids)
+        ]
+        self.buffer.pending.extend(messages)
+        return messages
+
+    def test_reserved_ids_do_not_collide(self):
+        reserved = writebehind.reserve_message_ids(5)
+        created = ChatMessage.objects.create(group=self.chatroom, author=self.user, body='direct')
+        self.assertGreater(created.id, max(reserved))
+        self.assertNotIn(created.id, writebehind.reserve_message_ids(5))
+
+    def test_flush_keeps_queue_order(self):
+        queued = self.queue(10)
+        self.buffer.flush()
+        self.assertEqual(list(self.chatroom.chat_messages.reverse()), queued)
+        self.assertEqual(self.buffer.pending, [])
+
+    def test_failed_flush_is_retried_first(self):
+        first = self.queue(3)
+        with mock.patch.object(writebehind, 'persist_messages', side_effect=DatabaseError('down')), \
+                self.assertLogs('monkeychat.writebehind', 'ERROR'):
+            self.buffer.flush()
+        later = self.queue(2)
+        self.assertEqual(self.buffer.pending, first + later)
+        self.buffer.flush()
+        self.assertEqual(self.chatroom.chat_messages.count(), 5)
+
+    def test_orphans_are_dropped_and_logged(self):
+        kept = self.queue(2)
+        orphan = self.queue(1)
+        # Its room was deleted while it sat in the queue
+        orphan[0].group_id = 10 ** 6
+        with self.assertLogs('monkeychat.writebehind', 'ERROR') as logs:
+            self.buffer.flush()
+        self.assertIn(f'Dropping queued message {orphan[0].id}', logs.output[0])
+        self.assertEqual(list(self.chatroom.chat_messages.reverse()), kept)
+
+    def test_merge_queued_pages_in_cursor_order(self):
+        # Stored and queued messages interleave by created
+        queued = self.queue(3)
+        stored = []
+        for i, message in enumerate(queued):
+            message.created = self.start + timedelta(microseconds=2 * i + 1)
+            stored.append(ChatMessage.objects.create(group=self.chatroom, author=self.user, body=f'stored {i}',
+                                                     created=self.start + timedelta(microseconds=2 * i)))
+        newest_first = sorted(stored + queued, key=lambda message: (message.created, message.id), reverse=True)
+
+        def page(limit, before=None, after=None):
+            # What the view's database query would return
+            return [
+                message for message in newest_first if message in stored
+                and (before is None or (message.created, message.id) < before)
+                and (after is None or (message.created, message.id) > after)
+            ][:limit]
+
+        with mock.patch.multiple(writebehind, ENABLED=True, buffer=self.buffer):
+            self.assertEqual(writebehind.merge_queued(self.chatroom, page(10), 10), newest_first)
+            before = (newest_first[1].created, newest_first[1].id)
+            older = writebehind.merge_queued(self.chatroom, page(3, before=before), 3, before=before)
+            self.assertEqual(older, newest_first[2:5])
+            after = (newest_first[3].created, newest_first[3].id)
+            newer = writebehind.merge_queued(self.chatroom, page(10, after=after), 10, after=after)
+            self.assertEqual(newer, newest_first[:3])
+
+
+class InstrumentationTests(TestCase):
+    def test_nested_recorders_see_the_same_work(self):
+        with recording(Recorder()) as outer:
+            ChatRoom.objects.count()
+            with recording(Recorder(statements=True)) as inner:
+                ChatRoom.objects.count()
+                ChatRoom.objects.count()
+                render_to_string('monkeychat/partials/online_user_count.html', {'online_count': 1})
+        self.assertEqual((outer.queries, inner.queries), (3, 2))
+        self.assertEqual(list(inner.statements.values()), [2])
+        self.assertGreater(inner.render_seconds, 0)
+        self.assertEqual(outer.render_seconds, inner.render_seconds)
+
+
+# Decodes each base64 frame on stdin with static/js/msgpack.js, then prints the
+# decoded value as JSON and the value encoded again, or the error
+MSGPACK_ROUND_TRIP = """
+const fs = require('fs');
+require('vm').runInThisContext(fs.readFileSync(process.argv[1], 'utf8'));
+for (const line of fs.readFileSync(0, 'utf8').split('\\n').filter(Boolean)) {
+    try {
+        const decoded = MessagePack.decode(new Uint8Array(Buffer.from(line, 'base64')));
+        const packed = Buffer.from(MessagePack.encode(decoded)).toString('base64');
+        console.log(JSON.stringify({decoded: decoded, packed: packed}));
+    } catch (e) {
+        console.log(JSON.stringify({error: e.message}));
+    }
+}
+"""
+
+
+@unittest.skipUnless(shutil.which('node'), 'node is not installed')
+class MsgpackClientTests(TestCase):
+    """The browser's MessagePack codec against msgpack.packb, byte for byte"""
+
+    def run_client(self, *frames):
+        script = os.path.join(settings.BASE_DIR, 'static', 'js', 'msgpack.js')
+        lines = '\n'.join(base64.b64encode(frame).decode() for frame in frames)
+        result = subprocess.run(['node', '-e', MSGPACK_ROUND_TRIP, script], input=lines,
+                                capture_output=True, text=True, check=True)
+        return [json.loads(line) for line in result.stdout.splitlines()]
+
+    def round_trip(self, *values):
+        return self.run_client(*[msgpack.packb(value) for value in values])
+
+    def assertRoundTrips(self, *values):
+        for value, result in zip(values, self.round_trip(*values), strict=True):
+            self.assertNotIn('error', result)
+            self.assertEqual(result['decoded'], value)
+            self.assertEqual(base64.b64decode(result['packed']), msgpack.packb(value))
+
+    def test_every_frame_type(self):
+        user = User.objects.create_user('packer', 'packer@example.com')
+        chatroom = ChatRoom.objects.create(group_name='packed')
+        author = Identity('Packer', 'https://example.com/avatar.png', 'packer')
+        text = message_data(ChatMessage.objects.create(group=chatroom, author=user, body='snow ❄'), author)
+        upload = message_data(ChatMessage.objects.create(
+            group=chatroom, author=user, original_filename='pic.png', file_url='https://example.com/pic.png',
+            is_image=True, thumbnail_url='https://example.com/thumb.png', thumbnail_width=400, thumbnail_height=300,
+        ), author)
+        frames = [
+            {'type': 'message', 'message': text, 'author_online': True},
+            {'type': 'message_update', 'message': upload},
+            {'type': 'sync', 'messages': [text, upload], 'refresh': False},
+            {'type': 'online_count', 'count': 3, 'online': [user.id, 70000, 2 ** 40]},
+            {'type': 'online_users', 'count': 65536},
+            {'type': 'chat_status', 'chatroom_name': chatroom.group_name, 'online': True, 'online_in_chats': False},
+            {'type': 'html', 'html': '<div class="online">❄</div>' * 3000},
+        ]
+        self.assertRoundTrips(*frames, frames)  # and batched into one array frame
+
+    def test_sizes(self):
+        self.assertRoundTrips(
+            [0, 127, 128, 255, 256, 65535, 65536, 2 ** 32 - 1, 2 ** 32, 2 ** 53 - 1],
+            [-1, -32, -33, -128, -129, -32768, -32769, -2 ** 31, -2 ** 31 - 1, -(2 ** 53 - 1)],
+            [0.5, -1.25e300],
+            ['', 'a' * 31, 'a' * 32, 'a' * 255, 'a' * 256, 'a' * 65536],
+            [list(range(15)), list(range(16)), list(range(65536))],
+            [{str(i): i for i in range(15)}, {str(i): None for i in range(16)}],
+        )
+
+    def test_timestamps_and_extensions(self):
+        stamps = [msgpack.Timestamp(1700000000), msgpack.Timestamp(1700000000, 123000000), msgpack.Timestamp(2 ** 34, 5000000)]
+        results = self.round_trip(*stamps, msgpack.ExtType(5, b'abc'))
+        for stamp, result in zip(stamps, results):
+            self.assertEqual(result['decoded'], stamp.to_datetime().isoformat(timespec='milliseconds').replace('+00:00', 'Z'))
+            self.assertEqual(base64.b64decode(result['packed']), msgpack.packb(stamp))
+        self.assertEqual(results[-1]['decoded'], {'type': 5, 'data': {'0': 97, '1': 98, '2': 99}})
+
+    def test_malformed_frames(self):
+        results = self.run_client(
+            msgpack.packb({'type': 'online_users', 'count': 3})[:-1],
+            msgpack.packb('truncated string')[:5],
+            msgpack.packb(1) + b'\x00',
+            b'\xc1',
+        )
+        self.assertEqual([result.get('error') for result in results], [
+            'Truncated MessagePack data', 'Truncated MessagePack data',
+            'Extra bytes after MessagePack data', 'Unsupported MessagePack type 0xc1',
+        ])
+
+
+class UploadBackendTests(unittest.TestCase):
+    def test_cloudinary_keeps_the_original_filename(self):
+        with mock.patch('cloudinary.uploader.upload', return_value={'secure_url': 'https://example.com/chat/snow.png'}) as upload:
+            CloudinaryBackend().upload('/tmp/tmpa1b2c3.png', 'snow.png', 'chat')
+        self.assertEqual(upload.call_args.kwargs['filename_override'], 'snow.png')
+
+
+class HashRingTests(unittest.TestCase):
+    rooms = [f'room-{i}' for i in range(2000)]
+
+    def test_spreads_rooms_over_every_shard(self):
+        ring = HashRing(['a', 'b', 'c'])
+        owners = Counter(ring.node_for(room) for room in self.rooms)
+        self.assertEqual(set(owners), {'a', 'b', 'c'})
+        for count in owners.values():
+            self.assertGreater(count, len(self.rooms) / 3 * 0.75)
+
+    def test_list_order_does_not_matter(self):
+        ring, reordered = HashRing(['a', 'b', 'c']), HashRing(['c', 'a', 'b'])
+        self.assertTrue(all(ring.node_for(room) == reordered.node_for(room) for room in self.rooms))
+
+    def test_adding_a_shard_only_moves_rooms_onto_it(self):
+        before, after = HashRing(['a', 'b', 'c']), HashRing(['a', 'b', 'c', 'd'])
+        moved = [room for room in self.rooms if before.node_for(room) != after.node_for(room)]
+        self.assertTrue(all(after.node_for(room) == 'd' for room in moved))
+        self.assertLess(len(moved), len(self.rooms) / 4 * 1.25)
+
+    def test_parse_shards(self):
+        self.assertEqual(
+            parse_shards(['a=redis://one:6379/0', ' redis://two:6379/0 ']),
+            {'a': 'redis://one:6379/0', 'redis://two:6379/0': 'redis://two:6379/0'},
+        )
+
+
+@unittest.skipUnless(fakeredis, 'fakeredis is not installed')
+class FakeRedisTestCase(unittest.TestCase):
+    """Routes every room to one shard backed by fakeredis"""
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.shard = self.make_shard()
+        patcher = mock.patch.multiple(redis_utils, SHARDS={'fake': self.shard}, ring=HashRing(['fake']))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        redis_utils.local_presence.rooms.clear()
+        self.addCleanup(redis_utils.local_presence.rooms.clear)
+
+    def make_shard(self, **options):
+        shard = redis_utils.Shard('fake', 'redis://fake')
+        shard.pool = redis.BlockingConnectionPool(
+            connection_class=fakeredis.FakeConnection, server=self.server,
+            **{**redis_utils.POOL_OPTIONS, **options}
+        )
+        return shard
+
+
+class RedisPoolTests(FakeRedisTestCase):
+    def test_exhausted_pool_waits_instead_of_tripping_the_breaker(self):
+        self.shard.pool = self.make_shard(max_connections=1, timeout=2).pool
+        held = self.shard.pool.get_connection()
+        threading.Timer(0.2, self.shard.pool.release, [held]).start()
+        self.assertTrue(redis_utils.add_user_online('room', 1, 'tab'))
+        self.assertEqual(self.shard.breaker.failures, 0)
+        self.assertEqual(redis_utils.local_presence.rooms, {})
+
+    def test_pools_time_out_hung_sockets(self):
+        shard = redis_utils.Shard('timeouts', 'redis://localhost:6379/0')
+        pool = shard.get_client().connection_pool
+        self.assertIsInstance(pool, redis.BlockingConnectionPool)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], redis_utils.REDIS_SOCKET_TIMEOUT)
+        self.assertEqual(pool.connection_kwargs['socket_connect_timeout'], redis_utils.REDIS_CONNECT_TIMEOUT)
+
+
+class PresenceTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        # One clock for presence expiry and the breaker's retry timer
+        self.now = 1_000_000.0
+        clock = mock.patch.object(redis_utils, 'time', mock.Mock(time=lambda: self.now, monotonic=lambda: self.now))
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.async_client = mock.patch.object(
+            self.shard, 'get_async_client', lambda: fakeredis.FakeAsyncRedis(server=self.server, decode_responses=True),
+        )
+        self.async_client.start()
+        self.addCleanup(self.async_client.stop)
+
+    def assertTabsRefcounted(self, presence):
+        self.assertTrue(presence.add('room', 1, 'tab-a'))
+        self.assertFalse(presence.add('room', 1, 'tab-b'))
+        self.assertFalse(presence.remove('room', 1, 'tab-a'))
+        self.assertEqual(presence.users('room'), {1})
+        self.assertTrue(presence.remove('room', 1, 'tab-b'))
+        self.assertFalse(presence.remove('room', 1, 'tab-b'))
+        self.assertEqual(presence.users('room'), set())
+
+    def test_tabs_are_refcounted(self):
+        self.assertTabsRefcounted(redis_utils.RedisPresence(self.shard.get_client()))
+        self.assertTabsRefcounted(redis_utils.local_presence)
+
+    def test_async_and_sync_calls_share_presence(self):
+        self.assertTrue(async_to_sync(redis_utils.aadd_user_online)('room', 1, 'tab-a'))
+        self.assertFalse(redis_utils.add_user_online('room', 1, 'tab-b'))
+        self.assertEqual(async_to_sync(redis_utils.aget_online_users)('room'), [1])
+        self.assertFalse(async_to_sync(redis_utils.aremove_user_online)('room', 1, 'tab-b'))
+        self.assertTrue(redis_utils.remove_user_online('room', 1, 'tab-a'))
+        self.assertEqual(redis_utils.local_presence.rooms, {})
+
+    def assertCrashedSocketsExpire(self, presence):
+        presence.add('room', 1, 'crashed')
+        presence.add('room', 2, 'alive')
+        self.now += redis_utils.PRESENCE_TTL - 1
+        presence.heartbeat('room', 2, 'alive')
+        self.now += 2
+        self.assertEqual(presence.users('room'), {2})
+        self.assertEqual(presence.counts_many(['room', 'empty']), {'room': 1, 'empty': 0})
+        # Coming back after the crash counts as coming online again
+        self.assertTrue(presence.add('room', 1, 'reloaded'))
+
+    def test_crashed_sockets_expire(self):
+        self.assertCrashedSocketsExpire(redis_utils.RedisPresence(self.shard.get_client()))
+        self.assertCrashedSocketsExpire(redis_utils.local_presence)
+
+    def test_breaker_falls_back_and_recovers(self):
+        breaker = self.shard.breaker
+        self.server.connected = False
+        with self.assertLogs('monkeychat.redis_utils', 'WARNING') as logs:
+            for tab in range(redis_utils.REDIS_FAILURE_THRESHOLD):
+                redis_utils.add_user_online('room', 1, f'tab-{tab}')
+        self.assertIsNotNone(breaker.opened_at)
+        self.assertTrue(any('opening circuit breaker' in line for line in logs.output))
+        # Open: calls go straight to this process without trying Redis
+        with mock.patch.object(self.shard, 'get_client') as get_client:
+            self.assertEqual(redis_utils.get_online_users('room'), [1])
+            self.assertTrue(redis_utils.add_user_online('room', 2, 'tab'))
+        get_client.assert_not_called()
+
+        # Still down when the retry comes round: open for another retry_after
+        self.now += redis_utils.REDIS_RETRY_AFTER
+        with self.assertLogs('monkeychat.redis_utils', 'ERROR'):
+            redis_utils.heartbeat('room', 2, 'tab')
+        self.assertEqual(breaker.opened_at, self.now)
+
+        self.server.connected = True
+        self.now += redis_utils.REDIS_RETRY_AFTER
+        redis_utils.heartbeat('room', 2, 'tab')
+        self.assertEqual((breaker.failures, breaker.opened_at), (0, None))
+        # The heartbeat repopulated Redis, which answers again
+        self.assertEqual(redis_utils.get_online_users('room'), [2])
+        self.assertEqual(self.shard.get_client().zcard('presence:room'), 1)
+
+
+class BroadcastCoalescerTests(unittest.TestCase):
+    def test_bursts_share_a_flush_per_window(self):
+        flushes = []
+
+        async def burst():
+            coalescer = BroadcastCoalescer(0.2)
+
+            async def flush():
+                flushes.append(state['count'])
+
+            state = {'count': 0}
+            for count in range(1, 6):
+                state['count'] = count
+                coalescer.schedule('room', flush)
+                coalescer.schedule('other-room', flush)
+                await asyncio.sleep(0.01)
+            # Idle keys go out straight away; the rest of the burst waits for the window
+            self.assertEqual(flushes, [1, 1])
+            await asyncio.sleep(0.2)
+            # One flush per key closes the window, sending the final state
+            self.assertEqual(flushes, [1, 1, 5, 5])
+
+        async_to_sync(burst)()
+
+
+class ConsumerTestCase(TransactionTestCase):
+    """Connects WebSocketCommunicators straight to the consumers, as chat_benchmark does"""
+
+    def setUp(self):
+        self.chatroom = ChatRoom.objects.create(group_name='public-chat')
+        self.user = User.objects.create_user('watcher', 'watcher@example.com')
+        redis_utils.local_presence.rooms.clear()
+        presence_broadcasts.pending.clear()
+        presence_broadcasts.last_sent.clear()
+        async_to_sync(get_channel_layer().flush)()
+
+    def communicator(self, user, path=None, protocol=JSON_PROTOCOL):
+        inner = URLRouter(routing.websocket_urlpatterns)
+
+        async def app(scope, receive, send):
+            return await inner(dict(scope, user=user), receive, send)
+        return WebsocketCommunicator(app, path or f'/ws/chatroom/{self.chatroom.group_name}', subprotocols=[protocol])
+
+    async def connect(self, user):
+        communicator = self.communicator(user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_frames(self, communicator, quiet=0.4):
+        """Every frame until none arrive for quiet seconds, with batches unpacked"""
+        frames = []
+        while not await communicator.receive_nothing(timeout=quiet):
+            frame = await communicator.receive_json_from()
+            frames += frame if isinstance(frame, list) else [frame]
+        return frames
+
+
+class PresenceBroadcastTests(ConsumerTestCase):
+    async def test_join_burst_is_coalesced(self):
+        users = [await User.objects.acreate(username=f'joiner{i}') for i in range(10)]
+        watcher = await self.connect(self.user)
+        await self.receive_frames(watcher)
+
+        layer = get_channel_layer()
+        group_send = layer.group_send
+        broadcasts = []
+
+        async def counting_group_send(group, message):
+            broadcasts.append(message['type'])
+            await group_send(group, message)
+
+        # Long enough that every join lands within one interval of the first
+        with mock.patch.object(presence_broadcasts, 'interval', 1), \
+                mock.patch.object(layer, 'group_send', counting_group_send):
+            joiners = [await self.connect(user) for user in users]
+            await asyncio.sleep(1)
+            counts = [frame for frame in await self.receive_frames(watcher) if frame['type'] == 'online_count']
+        # The watcher's own join opened the window, so the whole burst shares one broadcast
+        self.assertEqual(broadcasts.count('online_count_handler'), 1)
+        self.assertEqual(counts[-1]['count'], len(users))
+        self.assertEqual(len(counts[-1]['online']), len(users) + 1)
+
+        for communicator in [watcher, *joiners]:
+            await communicator.disconnect()
+
+
+class FrameBufferTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        # A wide window, so a burst always lands inside it
+        window = mock.patch('monkeychat.consumers.OUTBOUND_WINDOW', 0.5)
+        window.start()
+        self.addCleanup(window.stop)
+
+    def message_event(self, message_id):
+        return {'type': 'message_handler', 'message_id': message_id, 'data': {'id': message_id}, 'author_online': True}
+
+    def online_count_event(self, count):
+        return {'type': 'online_count_handler', 'online_count': count, 'online_user_ids': [], 'html': ''}
+
+    async def open_window(self, communicator):
+        # Sending a frame starts the window that the next burst waits out
+        await self.receive_frames(communicator)
+        await get_channel_layer().group_send(self.chatroom.group_name, self.message_event(0))
+        self.assertEqual((await communicator.receive_json_from())['message']['id'], 0)
+
+    async def test_burst_is_one_array_frame(self):
+        communicator = await self.connect(self.user)
+        await self.open_window(communicator)
+        layer = get_channel_layer()
+        for event in [self.message_event(1), self.online_count_event(3), self.message_event(2), self.online_count_event(4)]:
+            await layer.group_send(self.chatroom.group_name, event)
+
+        frame = await communicator.receive_json_from(timeout=2)
+        # Queued in order, with only the latest online count kept
+        self.assertEqual([(item['type'], item.get('message', {}).get('id'), item.get('count')) for item in frame], [
+            ('message', 1, None), ('message', 2, None), ('online_count', None, 4),
+        ])
+        self.assertTrue(await communicator.receive_nothing(timeout=0.6))
+        await communicator.disconnect()
+
+    async def test_slow_consumer_is_closed(self):
+        with mock.patch('monkeychat.consumers.OUTBOUND_LIMIT', 3):
+            communicator = await self.connect(self.user)
+        await self.open_window(communicator)
+        for message_id in range(1, 5):
+            await get_channel_layer().group_send(self.chatroom.group_name, self.message_event(message_id))
+
+        # The fourth frame overflows the buffer; nothing queued is sent after the close
+        self.assertEqual(await communicator.receive_output(timeout=2), {'type': 'websocket.close', 'code': 1013})
+        self.assertTrue(await communicator.receive_nothing(timeout=0.6))
+        await communicator.disconnect()
+        self.assertEqual(redis_utils.local_presence.users(self.chatroom.group_name), set())
+
+
+@unittest.skipUnless(os.environ.get('CHAT_TEST_REDIS_SHARDS'), 'set CHAT_TEST_REDIS_SHARDS to "name=url,..." of local redis-servers')
+class ShardedRedisTests(unittest.TestCase):
+    """Runs against real Redis instances, e.g. redis-server --port 6380 and --port 6381"""
+
+    def setUp(self):
+        entries = os.environ['CHAT_TEST_REDIS_SHARDS'].split(',')
+        self.shards = {name: redis_utils.Shard(name, url) for name, url in parse_shards(entries).items()}
+        for shard in self.shards.values():
+            shard.get_client().flushdb()
+        patcher = mock.patch.multiple(redis_utils, SHARDS=self.shards, ring=HashRing(self.shards))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.layer = ShardedRedisChannelLayer(shards=entries)
+
+    def test_presence_lives_on_the_room_shard(self):
+        rooms = [f'room-{i}' for i in range(20)]
+        for i, room in enumerate(rooms):
+            redis_utils.add_user_online(room, i, f'conn-{i}')
+        for room in rooms:
+            owner = redis_utils.shard_for(room)
+            for shard in self.shards.values():
+                self.assertEqual(shard.get_client().exists(f'presence:{room}'), int(shard is owner))
+        counts = redis_utils.get_chat_online_counts(rooms, exclude_user_id=0)
+        self.assertEqual(counts, {room: int(i != 0) for i, room in enumerate(rooms)})
+
+    def test_channel_layer_matches_presence_sharding(self):
+        names = list(self.shards)
+        for room in [f'room-{i}' for i in range(20)]:
+            self.assertEqual(names[self.layer.consistent_hash(room)], redis_utils.shard_for(room).name)
+
+    def test_group_send_across_shards(self):
+        async def exchange():
+            channels = [await self.layer.new_channel() for i in range(6)]
+            for i, channel in enumerate(channels):
+                await self.layer.group_add(f'room-{i}', channel)
+            for i in range(len(channels)):
+                await self.layer.group_send(f'room-{i}', {'type': 'test.message', 'room': i})
+            received = [(await self.layer.receive(channel))['room'] for channel in channels]
+            await self.layer.flush()
+            return received
+
+        self.assertEqual(async_to_sync(exchange)(), list(range(6)))
@@ -0,0 +1,120 @@
+import logging
+import mimetypes
+import os
+import tempfile
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from .models import ChatMessage
+from .events import message_update_event
+from .recent import replace_message
+from .images import CHAT_THUMBNAIL_SIZE, get_backend, probe_image, store_thumbnail
+
+logger = logging.getLogger(__name__)
+
+# Chat attachments: the view stores a pending message and broadcasts its
+# placeholder straight away, then a worker thread uploads the file through the
+# configured backend (see monkeychat.images) and broadcasts the finished
+# message in its place. Uploads lost to a restart stay pending until
+# fail_stale_uploads (the fail_stale_uploads command, run on release) marks
+# them failed.
+ATTACHMENT_FOLDER = 'chat'
+UPLOAD_WORKERS = getattr(settings, 'CHAT_UPLOAD_WORKERS', 4)
+# Comfortably longer than any real upload, so a live worker is never overtaken
+STALE_UPLOAD_AGE = timedelta(minutes=getattr(settings, 'CHAT_STALE_UPLOAD_MINUTES', 15))
+
+
+def attachment_metadata(source, filename, size):
+    """Model fields describing an attachment, so renders never parse its URL"""
+    probed = probe_image(source)
+    if probed:
+        content_type, width, height = probed
+        return {
+            'content_type': content_type or mimetypes.guess_type(filename)[0],
+            'file_size': size,
+            'image_width': width,
+            'image_height': height,
+            'is_image': True,
+        }
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    return {
+        'content_type': content_type,
+        'file_size': size,
+        'image_width': None,
+        'image_height': None,
+        # Pillow can't read SVGs, but browsers show them inline
+        'is_image': content_type == 'image/svg+xml',
+    }
+
+
+executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='chat-upload')
+
+
+def start_upload(message, uploaded_file):
+    """Upload a pending message's file in the background"""
+    # The request's copy of the file is cleaned up once the response is sent
+    suffix = os.path.splitext(uploaded_file.name)[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+        for chunk in uploaded_file.chunks():
+            tmp.write(chunk)
+    transaction.on_commit(lambda: executor.submit(finish_upload, message.id, tmp.name))
+
+
+def upload_thumbnail(backend, message, path):
+    try:
+        thumbnail = store_thumbnail(path, CHAT_THUMBNAIL_SIZE, message.original_filename, ATTACHMENT_FOLDER, backend=backend)
+    except Exception:
+        # The original is already up, so show that rather than fail the message
+        logger.exception(f"Thumbnail upload for chat attachment {message.id} failed")
+        return
+    if thumbnail is not None:
+        message.thumbnail_url, message.thumbnail_width, message.thumbnail_height = thumbnail
+
+
+def finish_upload(message_id, path):
+    try:
+        try:
+            message = ChatMessage.objects.select_related('group').get(id=message_id)
+        except ChatMessage.DoesNotExist:
+            return  # Deleted while uploading
+        backend = get_backend()
+        try:
+            message.file_url = backend.upload(path, message.original_filename, ATTACHMENT_FOLDER)
+            if message.is_image:
+                upload_thumbnail(backend, message, path)
+            message.upload_status = ChatMessage.UPLOAD_READY
+        except Exception:
+            logger.exception(f"Upload of chat attachment {message_id} failed")
+            message.upload_status = ChatMessage.UPLOAD_FAILED
+        message.save(update_fields=['file_url', 'thumbnail_url', 'thumbnail_width', 'thumbnail_height', 'upload_status'])
+        broadcast_update(message)
+    finally:
+        os.unlink(path)
+        close_old_connections()
+
+
+def broadcast_update(message):
+    # Swap the cached placeholder for the finished message
+    replace_message(message)
+    async_to_sync(get_channel_layer().group_send)(
+        message.group.group_name, message_update_event(message, message.group)
+    )
+
+
+def fail_stale_uploads(older_than=STALE_UPLOAD_AGE):
+    """Mark uploads pending for longer than older_than failed, returning how many"""
+    stale = ChatMessage.objects.select_related('group').filter(
+        upload_status=ChatMessage.UPLOAD_PENDING, created__lt=timezone.now() - older_than,
+    )
+    failed = 0
+    for message in stale:
+        # Only if it is still pending, in case its worker finished meanwhile
+        if ChatMessage.objects.filter(id=message.id, upload_status=ChatMessage.UPLOAD_PENDING).update(upload_status=ChatMessage.UPLOAD_FAILED):
+            message.upload_status = ChatMessage.UPLOAD_FAILED
+            broadcast_update(message)
+            failed += 1
+    return failed
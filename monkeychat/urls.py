@@ -11,4 +11,5 @@ urlpatterns = [
     path('leave/<chatroom_name>', chatroom_leave_view, name="chatroom-leave"),
     path('file-upload/<chatroom_name>', chat_file_upload, name="chat-file-upload"),
     path('older/<chatroom_name>', load_older_messages, name="load-older-messages"),
+    path('search/<chatroom_name>', search_messages_view, name="chat-search"),
 ]
\ No newline at end of file
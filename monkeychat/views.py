@@ -5,33 +5,47 @@ from asgiref.sync import async_to_sync
 from django.http import HttpResponse
 from django.contrib import messages
 from django.http import Http404
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from .models import *
 from .forms import *
+from .events import message_event
+from .writebehind import merge_queued
+from .uploads import attachment_metadata, start_upload
+from .history import latest_messages
+from .search import parse_search_cursor, search_messages
 
 
 
 @login_required
 def chat_view(request, chatroom_name='public-chat'):
     chat_group = get_object_or_404(ChatRoom, group_name=chatroom_name)
-    chat_messages = chat_group.chat_messages.all()[:30]  # Get the last 30 messages
     form = ChatMessageCreateForm()
 
+    # Members and their profiles in one query, shared by the checks below and the template
+    members = []
+    if chat_group.is_private or chat_group.groupchat_name:
+        members = list(chat_group.members.select_related('profile'))
+
     other_user = None
     if chat_group.is_private:
-        if request.user not in chat_group.members.all():
+        if request.user not in members:
             raise Http404("You are not a member of this private chat group.")
-        for member in chat_group.members.all():
+        for member in members:
             if member != request.user:
                 other_user = member
                 break
 
     if chat_group.groupchat_name:
-        if request.user not in chat_group.members.all():
+        if request.user not in members:
             if request.user.emailaddress_set.filter(verified=True).exists():
                 chat_group.members.add(request.user)
+                members.append(request.user)
             else:
                 messages.warning(request, "You must verify your email to join this group chat.")
                 return redirect('profile-settings')
+
+    chat_messages = latest_messages(chat_group)
             
     if request.htmx:
         form = ChatMessageCreateForm(request.POST)
@@ -50,6 +64,7 @@ def chat_view(request, chatroom_name='public-chat'):
         'chat_messages': chat_messages,
         'form': form,
         'other_user': other_user,
+        'members': members,
         'chatroom_name': chatroom_name,
         'chat_group': chat_group,
     }
@@ -61,17 +76,17 @@ def get_or_create_chatroom(request, username):
         return redirect('home')
     
     other_user = User.objects.get(username=username)
-    my_chatrooms = request.user.chat_groups.filter(is_private=True)
+    dm_key = ChatRoom.dm_key_for(request.user, other_user)
 
-    chatroom = None
-    if my_chatrooms.exists():
-        for room in my_chatrooms:
-            if other_user in room.members.all():
-                chatroom = room
-                break
+    chatroom = ChatRoom.objects.filter(dm_key=dm_key).first()
     if not chatroom:
-        chatroom = ChatRoom.objects.create(is_private=True)
-        chatroom.members.add(other_user, request.user)
+        try:
+            with transaction.atomic():
+                chatroom = ChatRoom.objects.create(is_private=True, dm_key=dm_key)
+                chatroom.members.add(other_user, request.user)
+        except IntegrityError:
+            # The other user opened the chat at the same moment; use their room
+            chatroom = ChatRoom.objects.get(dm_key=dm_key)
 
     return redirect('chatroom', chatroom_name=chatroom.group_name)
 
@@ -107,15 +122,15 @@ def chatroom_edit_view(request, chatroom_name):
             form.save()
 
             remove_members = request.POST.getlist('remove_members')
-            for member_id in remove_members:
-                member = User.objects.get(id=member_id)
-                chat_group.members.remove(member)
+            if remove_members:
+                chat_group.members.remove(*chat_group.members.filter(id__in=remove_members))
 
             return redirect('chatroom', chatroom_name)
 
     context = {
         'form': form,
         'chat_group': chat_group,
+        'members': chat_group.members.select_related('profile'),
     }
 
     return render(request, 'monkeychat/chatroom_edit.html', context)
@@ -162,8 +177,20 @@ def chatroom_leave_view(request, chatroom_name):
 @login_required
 def load_older_messages(request, chatroom_name):
     chat_group = get_object_or_404(ChatRoom, group_name=chatroom_name)
-    offset = int(request.GET.get('offset', 0))
-    older_messages = chat_group.chat_messages.all()[offset:offset+20]
+    older_messages = chat_group.chat_messages.all()
+
+    # Page back from the oldest message the client has, rather than by offset,
+    # so new messages arriving meanwhile can't shift the window
+    cursor = request.GET.get('before')
+    position = None
+    if cursor:
+        position = ChatMessage.parse_cursor(cursor)
+        if position is None:
+            return HttpResponse(status=400)
+        created, message_id = position
+        older_messages = older_messages.filter(Q(created__lt=created) | Q(created=created, id__lt=message_id))
+
+    older_messages = merge_queued(chat_group, older_messages[:20], 20, before=position)
     
     context = {
         'chat_messages': older_messages,
@@ -171,22 +198,50 @@ def load_older_messages(request, chatroom_name):
     }
     return render(request, 'monkeychat/partials/older_messages.html', context)
 
+@login_required
+def search_messages_view(request, chatroom_name):
+    chat_group = get_object_or_404(ChatRoom, group_name=chatroom_name)
+    if chat_group.is_private or chat_group.groupchat_name:
+        if not chat_group.members.filter(id=request.user.id).exists():
+            raise Http404("You are not a member of this chat room.")
+
+    query = request.GET.get('q', '').strip()
+    after = None
+    cursor = request.GET.get('after')
+    if cursor:
+        after = parse_search_cursor(cursor)
+        if after is None:
+            return HttpResponse(status=400)
+
+    results, next_cursor = search_messages(chat_group, query, after) if query else ([], None)
+
+    context = {
+        'chat_group': chat_group,
+        'query': query,
+        'results': results,
+        'next_cursor': next_cursor,
+    }
+    # Further pages and searches from the page's own form only need the results
+    if request.htmx:
+        return render(request, 'monkeychat/partials/search_results.html', context)
+    return render(request, 'monkeychat/search.html', context)
+
 def chat_file_upload(request, chatroom_name):
     chat_group = get_object_or_404(ChatRoom, group_name=chatroom_name)
     
     if request.htmx and request.FILES:
         file = request.FILES['file']
+        # Everyone sees a placeholder now; the upload finishes in the background
         message = ChatMessage.objects.create(
-            file=file,
             author=request.user,
             group=chat_group,
-            original_filename=file.name
+            original_filename=file.name,
+            upload_status=ChatMessage.UPLOAD_PENDING,
+            **attachment_metadata(file, file.name, file.size)
         )
+        start_upload(message, file)
         channel_layer = get_channel_layer()
-        event = {
-            'type': 'message_handler',
-            'message_id': message.id,
-        }
+        event = message_event(message, chat_group)
         async_to_sync(channel_layer.group_send)(
             chatroom_name, event
         )
@@ -0,0 +1,195 @@
+import asyncio
+import atexit
+import logging
+import threading
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.utils import timezone
+from .models import ChatMessage
+from .events import note_message_author
+from .recent import push_message
+
+logger = logging.getLogger(__name__)
+
+# Write-behind mode: chat messages get their primary key straight away and are
+# broadcast before they are stored; a flusher then persists them in batches.
+#
+# Ordering: messages are ordered by (created, id) everywhere. created is
+# stamped when the message is queued and batches are written in queue order,
+# one flush at a time, so the stored history matches what was broadcast.
+#
+# Reads: chat_view and load_older_messages merge this process's queued
+# messages into their results. Messages queued by another process become
+# visible once that process flushes, at most FLUSH_INTERVAL later.
+#
+# Shutdown: whatever is still queued is flushed by an atexit hook.
+ENABLED = getattr(settings, 'CHAT_WRITE_BEHIND', False)
+FLUSH_INTERVAL = getattr(settings, 'CHAT_WRITE_BEHIND_INTERVAL_MS', 200) / 1000
+BATCH_SIZE = getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 100)
+ID_BLOCK_SIZE = 50
+
+
+def reserve_message_ids(count):
+    """Reserve a block of ChatMessage primary keys that no other insert will use.
+
+    Returns None when the database has no sequence we know how to advance.
+    """
+    table = ChatMessage._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [table, count],
+            )
+            return [row[0] for row in cursor.fetchall()]
+        if connection.vendor == 'sqlite':
+            # AUTOINCREMENT tables never hand out ids at or below sqlite_sequence.seq
+            cursor.execute("UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s", [count, table])
+            if cursor.rowcount == 0:
+                cursor.execute(f"SELECT COALESCE(MAX(id), 0) + %s FROM {table}", [count])
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, cursor.fetchone()[0]])
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+            last = cursor.fetchone()[0]
+            return list(range(last - count + 1, last + 1))
+    return None
+
+
+class MessageIdAllocator:
+    """Hands out reserved primary keys, fetching a new block when one runs out"""
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.ids = []
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            if not self.ids:
+                self.ids = reserve_message_ids(self.block_size) or []
+            return self.ids.pop(0) if self.ids else None
+
+
+class WriteBehindBuffer:
+    """Queue of unsaved chat messages, persisted with bulk_create"""
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = []
+        self.in_flight = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_task = None
+        self.wakeup = None
+
+    def add(self, message):
+        with self.lock:
+            self.pending.append(message)
+            full = len(self.pending) >= self.batch_size
+        self._ensure_flusher()
+        if full:
+            self.wakeup.set()
+
+    def queued_for(self, group_id):
+        """Messages for a room that may not be readable from the database yet"""
+        with self.lock:
+            return [message for message in self.in_flight + self.pending if message.group_id == group_id]
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        task = self.flush_task
+        if task is None or task.done() or task.get_loop() is not loop:
+            self.wakeup = asyncio.Event()
+            self.flush_task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await database_sync_to_async(self.flush)()
+            with self.lock:
+                if not self.pending:
+                    return
+
+    def flush(self):
+        # One flush at a time keeps batches in queue order
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                self.in_flight = batch
+            if not batch:
+                return
+            try:
+                persist_messages(batch)
+            except DatabaseError as e:
+                logger.error(f"Write-behind flush of {len(batch)} messages failed, retrying: {e}")
+                with self.lock:
+                    self.pending[:0] = batch
+            finally:
+                with self.lock:
+                    self.in_flight = []
+
+
+def persist_messages(batch):
+    stored = batch
+    try:
+        with transaction.atomic():
+            ChatMessage.objects.bulk_create(batch)
+    except IntegrityError:
+        # Most likely a room or author was deleted while its messages were
+        # queued; store the rest one by one and drop the orphans
+        stored = []
+        for message in batch:
+            try:
+                with transaction.atomic():
+                    # Not save(): post_save would look up the missing room
+                    ChatMessage.objects.bulk_create([message])
+                stored.append(message)
+            except IntegrityError as e:
+                # Clients already saw it, so it has to show up somewhere
+                logger.error(f"Dropping queued message {message.id} in room {message.group_id}, already broadcast: {e}")
+    # bulk_create skips post_save, so do what the signal would have done
+    for message in stored:
+        note_message_author(message.group.group_name, message.author_id)
+
+
+id_allocator = MessageIdAllocator(ID_BLOCK_SIZE)
+buffer = WriteBehindBuffer(FLUSH_INTERVAL, BATCH_SIZE)
+atexit.register(buffer.flush)
+
+
+async def create_message(**fields):
+    """Create a chat message, queueing the write when write-behind is enabled"""
+    if ENABLED:
+        message_id = await database_sync_to_async(id_allocator.next_id)()
+        if message_id is not None:
+            message = ChatMessage(id=message_id, created=timezone.now(), **fields)
+            buffer.add(message)
+            # bulk_create skips post_save, so the ring hears about it now
+            await database_sync_to_async(push_message)(message)
+            return message
+    return await ChatMessage.objects.acreate(**fields)
+
+
+def merge_queued(chat_group, messages, limit, before=None, after=None):
+    """Mix this process's queued messages for a room into a newest-first list.
+
+    before and after are optional (created, id) positions, as used by keyset
+    paging and reconnect sync.
+    """
+    if not ENABLED:
+        return messages
+    queued = [
+        message for message in buffer.queued_for(chat_group.id)
+        if (before is None or (message.created, message.id) < before)
+        and (after is None or (message.created, message.id) > after)
+    ]
+    if not queued:
+        return messages
+    merged = {message.id: message for message in queued}
+    merged.update((message.id, message) for message in messages)
+    return sorted(merged.values(), key=lambda message: (message.created, message.id), reverse=True)[:limit]
@@ -2,6 +2,10 @@ from django.forms import ModelForm
 from django import forms
 from django.contrib.auth.models import User
 from .models import Profile
+from monkeychat.images import AVATAR_THUMBNAIL_SIZE, store_thumbnail
+import logging
+
+logger = logging.getLogger(__name__)
 
 class ProfileForm(ModelForm):
     class Meta:
@@ -24,13 +28,25 @@ class ProfileForm(ModelForm):
         # If a default avatar is selected and no new image was uploaded
         if has_default_avatar and not has_new_image:
             profile.image = None
+            profile.image_thumbnail_url = None
         # If a new image is uploaded, clear the default avatar selection
         elif has_new_image:
             profile.default_avatar = ''
+            profile.image_thumbnail_url = self.upload_avatar_thumbnail(self.files['image'])
         
         if commit:
             profile.save()
         return profile
+
+    def upload_avatar_thumbnail(self, image):
+        try:
+            thumbnail = store_thumbnail(image, AVATAR_THUMBNAIL_SIZE, f'avatar_{self.instance.user_id}', 'avatars', crop=True)
+        except Exception:
+            logger.exception("Avatar thumbnail upload failed")
+            return None
+        finally:
+            image.seek(0)  # CloudinaryField uploads the original from the same file
+        return thumbnail and thumbnail[0]
         
         
 class EmailForm(ModelForm):
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 15:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monkeyusers', '0003_profile_default_avatar'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='image_thumbnail_url',
+            field=models.URLField(blank=True, max_length=500, null=True),
+        ),
+    ]
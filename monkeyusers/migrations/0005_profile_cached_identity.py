@@ -0,0 +1,46 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_cached_identity(apps, schema_editor):
+    # Historical models have no methods, so this mirrors Profile.build_*
+    Profile = apps.get_model('monkeyusers', 'Profile')
+    for profile in Profile.objects.select_related('user').iterator():
+        if profile.image:
+            avatar = profile.image.url
+        elif profile.default_avatar:
+            avatar = f'{settings.STATIC_URL}images/defaultAvatars/{profile.default_avatar}'
+        else:
+            avatar = f'{settings.STATIC_URL}images/avatar.png'
+        profile.cached_name = profile.displayname or profile.user.username
+        profile.cached_avatar = avatar
+        profile.cached_avatar_thumbnail = profile.image_thumbnail_url if profile.image and profile.image_thumbnail_url else avatar
+        profile.save(update_fields=['cached_name', 'cached_avatar', 'cached_avatar_thumbnail'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monkeyusers', '0004_profile_image_thumbnail_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='cached_avatar',
+            field=models.CharField(blank=True, default='', max_length=500),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='cached_avatar_thumbnail',
+            field=models.CharField(blank=True, default='', max_length=500),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='cached_name',
+            field=models.CharField(blank=True, default='', max_length=150),
+        ),
+        migrations.RunPython(backfill_cached_identity, migrations.RunPython.noop),
+    ]
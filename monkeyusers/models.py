@@ -1,30 +1,110 @@
+from collections import namedtuple
 from django.db import models
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
 from cloudinary.models import CloudinaryField
 
+# What message rows and member lists show for a user
+Identity = namedtuple('Identity', ['name', 'avatar', 'username'])
+CACHED_IDENTITY_FIELDS = ['cached_name', 'cached_avatar', 'cached_avatar_thumbnail']
+
 
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     image = CloudinaryField('image', null=True, blank=True)
+    # Small square variant of image for avatar circles, made when the image is uploaded
+    image_thumbnail_url = models.URLField(max_length=500, null=True, blank=True)
     default_avatar = models.CharField(max_length=50, null=True, blank=True)  # Store default avatar selection
     displayname = models.CharField(max_length=20, null=True, blank=True)
     info = models.TextField(null=True, blank=True) 
+    # Denormalized copies of name, avatar and avatar_thumbnail, refreshed on every save
+    cached_name = models.CharField(max_length=150, blank=True, default='')
+    cached_avatar = models.CharField(max_length=500, blank=True, default='')
+    cached_avatar_thumbnail = models.CharField(max_length=500, blank=True, default='')
     
     def __str__(self):
         return str(self.user)
-    
-    @property
-    def name(self):
+
+    def save(self, *args, **kwargs):
+        # A new image only has a URL once CloudinaryField has uploaded it during
+        # the save; otherwise the cached fields go out with this one save
+        uploading = isinstance(self.image, UploadedFile)
+        if not uploading and self.update_cached_identity() and kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], *CACHED_IDENTITY_FIELDS}
+        super().save(*args, **kwargs)
+        if uploading:
+            self.refresh_cached_identity()
+
+    def update_cached_identity(self):
+        """Set the cached name and avatars from the current fields, returning whether they changed"""
+        cached = (self.build_name(), self.build_avatar(), self.build_avatar_thumbnail())
+        if cached == (self.cached_name, self.cached_avatar, self.cached_avatar_thumbnail):
+            return False
+        self.cached_name, self.cached_avatar, self.cached_avatar_thumbnail = cached
+        return True
+
+    def refresh_cached_identity(self):
+        if self.update_cached_identity():
+            super().save(update_fields=CACHED_IDENTITY_FIELDS)
+
+    def build_name(self):
         if self.displayname:
             return self.displayname
-        return self.user.username 
-    
-    @property
-    def avatar(self):
+        return self.user.username
+
+    def build_avatar(self):
         # Priority: Custom uploaded image > Default avatar selection > Fallback avatar
         if self.image:
             return self.image.url
         elif self.default_avatar:
             return f'{settings.STATIC_URL}images/defaultAvatars/{self.default_avatar}'
-        return f'{settings.STATIC_URL}images/avatar.png'
+        return default_avatar_url()
+
+    def build_avatar_thumbnail(self):
+        # For the small avatar circles; falls back to the full avatar for older uploads
+        if self.image and self.image_thumbnail_url:
+            return self.image_thumbnail_url
+        return self.build_avatar()
+    
+    @property
+    def name(self):
+        return self.cached_name or self.build_name()
+    
+    @property
+    def avatar(self):
+        return self.cached_avatar or self.build_avatar()
+
+    @property
+    def avatar_thumbnail(self):
+        return self.cached_avatar_thumbnail or self.build_avatar_thumbnail()
+
+
+def default_avatar_url():
+    return f'{settings.STATIC_URL}images/avatar.png'
+
+
+def fallback_identity(username=''):
+    """Identity for a user without a Profile row, or without a User row when username is empty"""
+    return Identity(username or 'Deleted user', default_avatar_url(), username)
+
+
+def get_identities(user_ids):
+    """Map every user id to an Identity in one query, for renderers that skip the profile join"""
+    user_ids = set(user_ids)
+    profiles = Profile.objects.filter(user_id__in=user_ids).select_related('user').only(
+        'user__username', 'cached_name', 'cached_avatar_thumbnail',
+        'displayname', 'image', 'image_thumbnail_url', 'default_avatar',
+    )
+    identities = {
+        profile.user_id: Identity(profile.name, profile.avatar_thumbnail, profile.user.username)
+        for profile in profiles
+    }
+    # Users whose profile is missing still show up, at the cost of a second query
+    missing = user_ids - identities.keys()
+    if missing:
+        usernames = dict(User.objects.filter(id__in=missing).values_list('id', 'username'))
+        for user_id in missing:
+            # A cached message can outlive its author's account
+            identities[user_id] = fallback_identity(usernames.get(user_id, ''))
+    return identities
@@ -8,7 +8,7 @@ from django.contrib import messages
 from allauth.account.signals import user_signed_up
 
 @receiver(post_save, sender=User)       
-def user_postsave(sender, instance, created, **kwargs):
+def user_postsave(sender, instance, created, update_fields, **kwargs):
     user = instance
     
     # add profile if user is created
@@ -17,6 +17,10 @@ def user_postsave(sender, instance, created, **kwargs):
             user = user,
         )
     else:
+        # Profiles without a display name show the username; logins only touch last_login
+        if (update_fields is None or 'username' in update_fields) and hasattr(user, 'profile'):
+            user.profile.refresh_cached_identity()
+
         # update allauth emailaddress if exists 
         try:
             email_address = EmailAddress.objects.get_primary(user)
@@ -1,3 +1,49 @@
+from unittest import mock
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save
 from django.test import TestCase
+from monkeychat.tests import QueryBudgetTestCase
+from .models import Profile, default_avatar_url, get_identities
 
-# Create your tests here.
+
+class ProfileViewQueryBudgetTests(QueryBudgetTestCase):
+    def test_own_profile(self):
+        self.get_within_budget(3, '/profile/')
+
+    def test_other_profile(self):
+        other_user = self.make_users(1)[0]
+        response = self.get_within_budget(4, f'/@{other_user.username}/')
+        self.assertContains(response, f'@{other_user.username}')
+
+
+class CachedIdentityTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('monkey', 'monkey@example.com')
+
+    def test_profile_edit_saves_once(self):
+        saves = []
+        receiver = lambda sender, instance, **kwargs: saves.append(instance.cached_name)
+        post_save.connect(receiver, sender=Profile)
+        self.addCleanup(post_save.disconnect, receiver, sender=Profile)
+        profile = Profile.objects.get(user=self.user)
+        profile.displayname = 'Bubbles'
+        profile.save()
+        self.assertEqual(saves, ['Bubbles'])
+
+    def test_login_leaves_identity_alone(self):
+        with mock.patch.object(Profile, 'refresh_cached_identity') as refresh:
+            self.user.save(update_fields=['last_login'])
+            refresh.assert_not_called()
+            self.user.username = 'chimp'
+            self.user.save(update_fields=['username'])
+            refresh.assert_called_once()
+
+    def test_identity_without_profile(self):
+        Profile.objects.filter(user=self.user).delete()
+        identity = get_identities([self.user.id])[self.user.id]
+        self.assertEqual((identity.name, identity.username), ('monkey', 'monkey'))
+        self.assertEqual(identity.avatar, default_avatar_url())
+
+    def test_identity_without_user(self):
+        identity = get_identities([10 ** 6])[10 ** 6]
+        self.assertEqual((identity.name, identity.username), ('Deleted user', ''))
@@ -13,7 +13,7 @@ from .forms import *
 
 def profile_view(request, username=None):
     if username:
-        profile = get_object_or_404(User, username=username).profile
+        profile = get_object_or_404(Profile.objects.select_related('user'), user__username=username)
     else:
         try:
             profile = request.user.profile
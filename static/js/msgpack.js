@@ -0,0 +1,226 @@
+// Minimal MessagePack codec for the compact WebSocket protocol (see
+// monkeychat.protocol). Covers what msgpack.packb produces for chat frames:
+// nil, booleans, integers, floats, strings, binary, arrays, maps and
+// extensions, with the timestamp extension read as a Date. Encoding picks the
+// smallest format for each value, as msgpack.packb does, so the two produce
+// the same bytes; monkeychat.tests round-trips every frame type through both.
+// Exposes MessagePack.encode and MessagePack.decode like @msgpack/msgpack.
+(function (root) {
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+    const TIMESTAMP_TYPE = -1;
+
+    function decodeTimestamp(data) {
+        const view = new DataView(data.buffer, data.byteOffset, data.byteLength);
+        let seconds, nanoseconds;
+        if (data.length === 4) {
+            seconds = view.getUint32(0);
+            nanoseconds = 0;
+        } else if (data.length === 8) {
+            // 30 bits of nanoseconds, then 34 bits of seconds
+            const high = view.getUint32(0);
+            nanoseconds = high >>> 2;
+            seconds = (high & 0x3) * 0x100000000 + view.getUint32(4);
+        } else if (data.length === 12) {
+            nanoseconds = view.getUint32(0);
+            seconds = Number(view.getBigInt64(4));
+        } else {
+            throw new Error('Bad MessagePack timestamp length ' + data.length);
+        }
+        return new Date(seconds * 1000 + nanoseconds / 1e6);
+    }
+
+    function decode(bytes) {
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let offset = 0;
+
+        function need(length) {
+            if (offset + length > bytes.length) throw new RangeError('Truncated MessagePack data');
+            const start = offset;
+            offset += length;
+            return start;
+        }
+
+        function take(length) {
+            const start = need(length);
+            return bytes.subarray(start, offset);
+        }
+
+        const u8 = function () { return view.getUint8(need(1)); };
+        const u16 = function () { return view.getUint16(need(2)); };
+        const u32 = function () { return view.getUint32(need(4)); };
+
+        function str(length) {
+            return textDecoder.decode(take(length));
+        }
+
+        function array(length) {
+            const items = [];
+            for (let i = 0; i < length; i++) items.push(read());
+            return items;
+        }
+
+        function map(length) {
+            const object = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                if (typeof key !== 'string' && typeof key !== 'number') throw new Error('Unsupported MessagePack map key');
+                if (key === '__proto__') throw new Error('MessagePack map key __proto__ is not allowed');
+                object[key] = read();
+            }
+            return object;
+        }
+
+        function ext(length) {
+            const type = view.getInt8(need(1));
+            const data = take(length).slice();
+            return type === TIMESTAMP_TYPE ? decodeTimestamp(data) : { type: type, data: data };
+        }
+
+        function read() {
+            const type = u8();
+            if (type <= 0x7f) return type;
+            if (type >= 0xe0) return type - 0x100;
+            if (type >= 0xa0 && type <= 0xbf) return str(type & 0x1f);
+            if (type >= 0x90 && type <= 0x9f) return array(type & 0x0f);
+            if (type >= 0x80 && type <= 0x8f) return map(type & 0x0f);
+            switch (type) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return take(u8()).slice();
+                case 0xc5: return take(u16()).slice();
+                case 0xc6: return take(u32()).slice();
+                case 0xc7: return ext(u8());
+                case 0xc8: return ext(u16());
+                case 0xc9: return ext(u32());
+                case 0xca: return view.getFloat32(need(4));
+                case 0xcb: return view.getFloat64(need(8));
+                case 0xcc: return u8();
+                case 0xcd: return u16();
+                case 0xce: return u32();
+                case 0xcf: return Number(view.getBigUint64(need(8)));
+                case 0xd0: return view.getInt8(need(1));
+                case 0xd1: return view.getInt16(need(2));
+                case 0xd2: return view.getInt32(need(4));
+                case 0xd3: return Number(view.getBigInt64(need(8)));
+                case 0xd4: return ext(1);
+                case 0xd5: return ext(2);
+                case 0xd6: return ext(4);
+                case 0xd7: return ext(8);
+                case 0xd8: return ext(16);
+                case 0xd9: return str(u8());
+                case 0xda: return str(u16());
+                case 0xdb: return str(u32());
+                case 0xdc: return array(u16());
+                case 0xdd: return array(u32());
+                case 0xde: return map(u16());
+                case 0xdf: return map(u32());
+            }
+            throw new Error('Unsupported MessagePack type 0x' + type.toString(16));
+        }
+
+        const value = read();
+        if (offset !== bytes.length) throw new Error('Extra bytes after MessagePack data');
+        return value;
+    }
+
+    function encode(value) {
+        const chunks = [];
+
+        function fixed(type, size, set, n) {
+            // A type byte followed by n as a big-endian value of size bytes
+            const bytes = new Uint8Array(1 + size);
+            bytes[0] = type;
+            if (size) set.call(new DataView(bytes.buffer), 1, n);
+            chunks.push(bytes);
+        }
+
+        function head(type, length, small, sizes) {
+            // sizes: type bytes for 8, 16 and 32 bit lengths (null where the format has none)
+            if (length < small) return chunks.push(Uint8Array.of(type | length));
+            const [type8, type16, type32] = sizes;
+            if (type8 !== null && length < 0x100) return chunks.push(Uint8Array.of(type8, length));
+            if (length < 0x10000) return fixed(type16, 2, DataView.prototype.setUint16, length);
+            fixed(type32, 4, DataView.prototype.setUint32, length);
+        }
+
+        function number(n) {
+            if (!Number.isSafeInteger(n)) return fixed(0xcb, 8, DataView.prototype.setFloat64, n);
+            if (n >= 0) {
+                if (n < 0x80) return chunks.push(Uint8Array.of(n));
+                if (n < 0x100) return chunks.push(Uint8Array.of(0xcc, n));
+                if (n < 0x10000) return fixed(0xcd, 2, DataView.prototype.setUint16, n);
+                if (n < 0x100000000) return fixed(0xce, 4, DataView.prototype.setUint32, n);
+                return fixed(0xcf, 8, DataView.prototype.setBigUint64, BigInt(n));
+            }
+            if (n >= -0x20) return chunks.push(Uint8Array.of(n + 0x100));
+            if (n >= -0x80) return fixed(0xd0, 1, DataView.prototype.setInt8, n);
+            if (n >= -0x8000) return fixed(0xd1, 2, DataView.prototype.setInt16, n);
+            if (n >= -0x80000000) return fixed(0xd2, 4, DataView.prototype.setInt32, n);
+            fixed(0xd3, 8, DataView.prototype.setBigInt64, BigInt(n));
+        }
+
+        function timestamp(date) {
+            // The smallest of the 32, 64 and 96 bit timestamp formats that fits
+            const milliseconds = date.getTime();
+            const seconds = Math.floor(milliseconds / 1000);
+            const nanoseconds = (milliseconds - seconds * 1000) * 1e6;
+            let bytes;
+            if (nanoseconds === 0 && seconds >= 0 && seconds < 0x100000000) {
+                bytes = Uint8Array.of(0xd6, TIMESTAMP_TYPE & 0xff, 0, 0, 0, 0);
+                new DataView(bytes.buffer).setUint32(2, seconds);
+            } else if (seconds >= 0 && seconds < 0x400000000) {
+                bytes = Uint8Array.of(0xd7, TIMESTAMP_TYPE & 0xff, 0, 0, 0, 0, 0, 0, 0, 0);
+                const view = new DataView(bytes.buffer);
+                view.setUint32(2, nanoseconds * 4 + Math.floor(seconds / 0x100000000));
+                view.setUint32(6, seconds % 0x100000000);
+            } else {
+                bytes = Uint8Array.of(0xc7, 12, TIMESTAMP_TYPE & 0xff, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0);
+                const view = new DataView(bytes.buffer);
+                view.setUint32(3, nanoseconds);
+                view.setBigInt64(7, BigInt(seconds));
+            }
+            chunks.push(bytes);
+        }
+
+        function write(value) {
+            if (value === null || value === undefined) return chunks.push(Uint8Array.of(0xc0));
+            if (value === false) return chunks.push(Uint8Array.of(0xc2));
+            if (value === true) return chunks.push(Uint8Array.of(0xc3));
+            if (typeof value === 'number') return number(value);
+            if (typeof value === 'string') {
+                const bytes = textEncoder.encode(value);
+                head(0xa0, bytes.length, 0x20, [0xd9, 0xda, 0xdb]);
+                return chunks.push(bytes);
+            }
+            if (value instanceof Uint8Array) {
+                head(0, value.length, 0, [0xc4, 0xc5, 0xc6]);
+                return chunks.push(value);
+            }
+            if (value instanceof Date) return timestamp(value);
+            if (Array.isArray(value)) {
+                head(0x90, value.length, 0x10, [null, 0xdc, 0xdd]);
+                return value.forEach(write);
+            }
+            const keys = Object.keys(value).filter(function (key) { return value[key] !== undefined; });
+            head(0x80, keys.length, 0x10, [null, 0xde, 0xdf]);
+            keys.forEach(function (key) {
+                write(key);
+                write(value[key]);
+            });
+        }
+
+        write(value);
+        const length = chunks.reduce(function (total, chunk) { return total + chunk.length; }, 0);
+        const out = new Uint8Array(length);
+        let offset = 0;
+        chunks.forEach(function (chunk) {
+            out.set(chunk, offset);
+            offset += chunk.length;
+        });
+        return out;
+    }
+
+    root.MessagePack = { encode: encode, decode: decode };
+})(globalThis);